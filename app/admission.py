@@ -0,0 +1,141 @@
+import asyncio
+import time
+from collections import deque
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from . import metrics
+from .config import Settings
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Routes dominated by one scarce resource share a bulkhead: the bcrypt pool
+# for "hashing", disk and the image pool for "upload", signature checks for
+# "introspection" (up to INTROSPECTION_MAX_TOKENS per call). Everything else
+# runs unlimited, so a burst of logins never holds up /api/v1/me.
+ROUTE_CLASSES = {
+    "/api/v1/login": "hashing",
+    "/token": "hashing",
+    "/api/v1/register": "hashing",
+    "/api/v1/update_password": "hashing",
+    "/api/v1/reset_password": "hashing",
+    "/api/v1/upload_profile_image": "upload",
+    "/api/v1/introspect": "introspection",
+}
+
+
+class Bulkhead:
+    def __init__(self, name: str, limit: int, queue_size: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = deque()
+        prefix = "admission_" + name
+        self.in_flight = metrics.gauge(
+            prefix + "_in_flight", "Requests holding a {} slot.".format(name)
+        )
+        self.queue_depth = metrics.gauge(
+            prefix + "_queue_depth", "Requests waiting for a {} slot.".format(name)
+        )
+        self.wait_time = metrics.histogram(
+            prefix + "_wait_seconds",
+            "Time spent waiting for a {} slot.".format(name),
+            buckets=WAIT_BUCKETS,
+        )
+        self.shed = metrics.counter(
+            prefix + "_shed_total",
+            "Requests rejected with 503 by the {} limit.".format(name),
+        )
+
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.in_flight.set(self.active)
+            self.wait_time.observe(0.0)
+            return True
+        if len(self.waiters) >= self.queue_size:
+            self.shed.inc()
+            return False
+
+        # release() hands its slot straight to the oldest waiter, so active
+        # is not touched here when the wait succeeds.
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self.queue_depth.set(len(self.waiters))
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.shed.inc()
+            return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if future in self.waiters:
+                self.waiters.remove(future)
+            self.queue_depth.set(len(self.waiters))
+            self.wait_time.observe(time.perf_counter() - start)
+
+    def release(self):
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                self.queue_depth.set(len(self.waiters))
+                return
+        self.active -= 1
+        self.in_flight.set(self.active)
+
+
+def configure():
+    limits = {
+        "hashing": (
+            Settings.ADMISSION_HASHING_LIMIT,
+            Settings.ADMISSION_HASHING_QUEUE,
+        ),
+        "upload": (Settings.ADMISSION_UPLOAD_LIMIT, Settings.ADMISSION_UPLOAD_QUEUE),
+        "introspection": (
+            Settings.ADMISSION_INTROSPECTION_LIMIT,
+            Settings.ADMISSION_INTROSPECTION_QUEUE,
+        ),
+    }
+    return {
+        name: Bulkhead(name, limit, queue_size, Settings.ADMISSION_QUEUE_TIMEOUT)
+        for name, (limit, queue_size) in limits.items()
+        if limit > 0
+    }
+
+
+bulkheads = configure()
+
+
+class AdmissionMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        bulkhead = None
+        if scope["type"] == "http":
+            bulkhead = bulkheads.get(ROUTE_CLASSES.get(scope["path"]))
+        if bulkhead is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await bulkhead.acquire():
+            response = JSONResponse(
+                {"detail": "Server is busy, please retry shortly"},
+                status_code=503,
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            bulkhead.release()
@@ -0,0 +1,343 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi.exceptions import HTTPException
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, hashing, models, schemas, token_store
+from .user_cache import cache as user_cache
+
+
+async def run(func, *args, **kwargs):
+    # Run a crud function against whichever session the request holds:
+    # AsyncSession goes to its version in ASYNC_VERSIONS, a sync Session
+    # runs on the thread pool so the event loop is never blocked on I/O.
+    if any(isinstance(arg, AsyncSession) for arg in (*args, *kwargs.values())):
+        return await ASYNC_VERSIONS[func](*args, **kwargs)
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args, **kwargs)
+    return await run_in_threadpool(func, *args, **kwargs)
+
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
+
+async def get_user_by_id(db: AsyncSession, user_id: int):
+    result = await db.execute(select(models.User).where(models.User.id == user_id))
+    return result.scalars().first()
+
+
+async def get_user_profile_image(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(models.User.user_profile_image).where(models.User.id == user_id)
+    )
+    return result.scalar()
+
+
+async def find_black_list_token(db: AsyncSession, token: str):
+    return await token_store.get_store().find_async(db, token)
+
+
+async def get_users_by_emails(db: AsyncSession, emails: List[str]):
+    result = await db.execute(select(models.User).where(models.User.email.in_(emails)))
+    return result.scalars().all()
+
+
+async def find_black_list_token_ids(db: AsyncSession, ids: List[str]):
+    return await token_store.get_store().find_many_async(db, ids)
+
+
+async def get_black_list_tokens_since(db: AsyncSession, last_id: int):
+    result = await db.execute(
+        select(models.BlackLists)
+        .where(models.BlackLists.id > last_id)
+        .order_by(models.BlackLists.id)
+    )
+    return result.scalars().all()
+
+
+async def create_user(db: AsyncSession, user: schemas.UserIn):
+    db_user = models.User(
+        hashed_password=await hashing.hash_password(user.password),
+        first_name=user.first_name,
+        last_name=user.last_name,
+        email=user.email,
+    )
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user_by_email(db, email)
+
+    if not user:
+        return False
+
+    if not await hashing.verify_password(password, user.hashed_password):
+        return False
+
+    return user
+
+
+async def update_password(password: str, db: AsyncSession, user: models.User):
+    if await hashing.verify_password(password, user.hashed_password):
+        raise HTTPException(
+            status_code=409, detail="Old password and updated password are same."
+        )
+    hashed_password = await hashing.hash_password(password)
+    await db.execute(
+        update(models.User)
+        .where(models.User.id == user.id)
+        .values(hashed_password=hashed_password)
+    )
+    await db.commit()
+    user_cache.invalidate(user.email)
+    return user
+
+
+async def create_reset_code(
+    db: AsyncSession,
+    email: str,
+    reset_code: str,
+    outbox_email: models.EmailOutbox = None,
+):
+    user_reset_code = models.Codes(
+        email=email,
+        reset_code=reset_code,
+        expired_in=datetime.now() + timedelta(days=10),
+    )
+    db.add(user_reset_code)
+    if outbox_email is not None:
+        db.add(outbox_email)
+    await db.commit()
+    await db.refresh(user_reset_code)
+    return user_reset_code
+
+
+async def claim_outbox_batch(db: AsyncSession, batch_size: int, max_attempts: int):
+    result = await db.execute(
+        select(models.EmailOutbox)
+        .where(
+            models.EmailOutbox.sent_at.is_(None),
+            models.EmailOutbox.next_attempt_at <= datetime.utcnow(),
+            models.EmailOutbox.attempts < max_attempts,
+        )
+        .order_by(models.EmailOutbox.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return result.scalars().all()
+
+
+async def finish_outbox_batch(db: AsyncSession):
+    await db.commit()
+
+
+async def delete_old_outbox_rows(db: AsyncSession, before: datetime, max_attempts: int):
+    result = await db.execute(
+        delete(models.EmailOutbox)
+        .where(
+            models.EmailOutbox.created_at < before,
+            or_(
+                models.EmailOutbox.sent_at.isnot(None),
+                models.EmailOutbox.attempts >= max_attempts,
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def count_undeliverable_outbox_rows(db: AsyncSession, max_attempts: int):
+    result = await db.execute(
+        select(func.count(models.EmailOutbox.id)).where(
+            models.EmailOutbox.sent_at.is_(None),
+            models.EmailOutbox.attempts >= max_attempts,
+        )
+    )
+    return result.scalar()
+
+
+async def save_black_list_token(db: AsyncSession, token: str, email: str):
+    return await token_store.get_store().save_async(db, token, email)
+
+
+async def delete_expired_black_list_tokens(db: AsyncSession, batch_size: int):
+    expired = (
+        select(models.BlackLists.id)
+        .where(models.BlackLists.expires_at < datetime.utcnow())
+        .limit(batch_size)
+    )
+    result = await db.execute(
+        delete(models.BlackLists)
+        .where(models.BlackLists.id.in_(expired))
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def consume_reset_code(db: AsyncSession, token: str):
+    statement = (
+        update(models.Codes)
+        .where(
+            models.Codes.reset_code == token,
+            models.Codes.active.is_(True),
+            models.Codes.expired_in > datetime.now(),
+        )
+        .values(active=False)
+        .execution_options(synchronize_session=False)
+    )
+    if db.bind.dialect.full_returning:
+        result = await db.execute(statement.returning(models.Codes.email))
+        return result.scalar()
+
+    if not (await db.execute(statement)).rowcount:
+        return None
+    result = await db.execute(
+        select(models.Codes.email).where(models.Codes.reset_code == token)
+    )
+    return result.scalar()
+
+
+async def delete_stale_reset_codes(db: AsyncSession):
+    result = await db.execute(
+        delete(models.Codes)
+        .where(
+            or_(
+                models.Codes.active.is_(False),
+                models.Codes.expired_in < datetime.now(),
+            )
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def update_user_profile(db: AsyncSession, user_data: schemas.UserBase, user):
+    await db.execute(
+        update(models.User).where(models.User.id == user.id).values(**user_data.dict())
+    )
+    await db.commit()
+    user_cache.invalidate(user.email)
+    return await get_user_by_email(db, user_data.email)
+
+
+async def upload_profile_image(db: AsyncSession, user_id: int, user_image: str):
+    result = await db.execute(
+        update(models.User)
+        .where(models.User.id == user_id)
+        .values(user_profile_image=user_image)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    user_cache.invalidate(user_id=user_id)
+    return result.rowcount
+
+
+async def delete_user_data(db: AsyncSession, user_id: int):
+    result = await db.execute(delete(models.User).where(models.User.id == user_id))
+    await db.commit()
+    user_cache.invalidate(user_id=user_id)
+    return result.rowcount
+
+
+async def create_refresh_token(
+    db: AsyncSession, user_id: int, family: str, token_hash: str, expires_at: datetime
+):
+    db_refresh_token = models.RefreshToken(
+        token_hash=token_hash, user_id=user_id, family=family, expires_at=expires_at
+    )
+    db.add(db_refresh_token)
+    await db.commit()
+    return db_refresh_token
+
+
+async def use_refresh_token(db: AsyncSession, token_hash: str):
+    statement = (
+        update(models.RefreshToken)
+        .where(
+            models.RefreshToken.token_hash == token_hash,
+            models.RefreshToken.revoked.is_(False),
+            models.RefreshToken.expires_at > datetime.utcnow(),
+        )
+        .values(revoked=True)
+        .execution_options(synchronize_session=False)
+    )
+    used = (await db.execute(statement)).rowcount
+    result = await db.execute(
+        select(models.RefreshToken).where(models.RefreshToken.token_hash == token_hash)
+    )
+    db_refresh_token = result.scalars().first()
+    if not used and db_refresh_token is not None and db_refresh_token.revoked:
+        await revoke_refresh_tokens(db, family=db_refresh_token.family)
+    await db.commit()
+    return db_refresh_token if used else None
+
+
+async def revoke_refresh_tokens(
+    db: AsyncSession, family: str = None, user_id: int = None
+):
+    statement = (
+        update(models.RefreshToken)
+        .where(models.RefreshToken.revoked.is_(False))
+        .values(revoked=True)
+        .execution_options(synchronize_session=False)
+    )
+    if family is not None:
+        statement = statement.where(models.RefreshToken.family == family)
+    if user_id is not None:
+        statement = statement.where(models.RefreshToken.user_id == user_id)
+    result = await db.execute(statement)
+    await db.commit()
+    return result.rowcount
+
+
+async def delete_expired_refresh_tokens(db: AsyncSession):
+    result = await db.execute(
+        delete(models.RefreshToken)
+        .where(models.RefreshToken.expires_at < datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+# The AsyncSession version of each crud function, for run().
+ASYNC_VERSIONS = {
+    crud.get_user_by_email: get_user_by_email,
+    crud.get_user_by_id: get_user_by_id,
+    crud.get_user_profile_image: get_user_profile_image,
+    crud.find_black_list_token: find_black_list_token,
+    crud.get_users_by_emails: get_users_by_emails,
+    crud.find_black_list_token_ids: find_black_list_token_ids,
+    crud.get_black_list_tokens_since: get_black_list_tokens_since,
+    crud.create_user: create_user,
+    crud.authenticate_user: authenticate_user,
+    crud.update_password: update_password,
+    crud.create_reset_code: create_reset_code,
+    crud.claim_outbox_batch: claim_outbox_batch,
+    crud.finish_outbox_batch: finish_outbox_batch,
+    crud.delete_old_outbox_rows: delete_old_outbox_rows,
+    crud.count_undeliverable_outbox_rows: count_undeliverable_outbox_rows,
+    crud.save_black_list_token: save_black_list_token,
+    crud.delete_expired_black_list_tokens: delete_expired_black_list_tokens,
+    crud.consume_reset_code: consume_reset_code,
+    crud.delete_stale_reset_codes: delete_stale_reset_codes,
+    crud.update_user_profile: update_user_profile,
+    crud.upload_profile_image: upload_profile_image,
+    crud.delete_user_data: delete_user_data,
+    crud.create_refresh_token: create_refresh_token,
+    crud.use_refresh_token: use_refresh_token,
+    crud.revoke_refresh_tokens: revoke_refresh_tokens,
+    crud.delete_expired_refresh_tokens: delete_expired_refresh_tokens,
+}
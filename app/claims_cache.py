@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from . import metrics, signing
+from .config import Settings
+
+claims_cache_hits = metrics.counter(
+    "claims_cache_hits_total", "Token verifications served from the claims cache."
+)
+claims_cache_misses = metrics.counter(
+    "claims_cache_misses_total", "Token verifications that decoded the JWT."
+)
+
+
+def token_digest(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+class ClaimsCache:
+    def __init__(self, max_size: int = Settings.CLAIMS_CACHE_SIZE):
+        self.max_size = max_size
+        # token digest -> (exp, signing kid, verified claims), least recently
+        # used first
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = token_digest(token)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._valid(entry):
+                self.entries.move_to_end(key)
+                claims_cache_hits.inc()
+                return entry[2]
+            if entry is not None:
+                del self.entries[key]
+        claims_cache_misses.inc()
+        return None
+
+    @staticmethod
+    def _valid(entry) -> bool:
+        # Once its signing key is retired and the keyring reloaded, a token
+        # stops verifying, so it must stop being served from here too.
+        expires_at, kid, _ = entry
+        return expires_at > time.time() and kid in signing.keyring.verification_keys
+
+    def put(self, token: str, claims: dict, kid: Optional[str] = None):
+        expires_at = claims.get("exp")
+        if self.max_size <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        with self._lock:
+            key = token_digest(token)
+            self.entries[key] = (expires_at, kid, claims)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def evict(self, token: str):
+        with self._lock:
+            self.entries.pop(token_digest(token), None)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def decode(self, token: str) -> dict:
+        # Same contract as signing.keyring.decode, JWTError included.
+        claims = self.get(token)
+        if claims is None:
+            claims = signing.keyring.decode(token)
+            self.put(token, claims, signing.keyring.codec.header(token).get("kid"))
+        return claims
+
+    def stats(self):
+        hits, misses = claims_cache_hits.value, claims_cache_misses.value
+        return {
+            "entries": len(self.entries),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+
+cache = ClaimsCache()
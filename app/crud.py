@@ -1,25 +1,55 @@
 from datetime import datetime, timedelta
+from typing import List
 
 from fastapi.exceptions import HTTPException
-from passlib.context import CryptContext
+from sqlalchemy import delete, or_, select, update
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from . import models, schemas
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from . import hashing, models, schemas, token_store
+from .user_cache import cache as user_cache
 
 
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
 
+def get_user_by_id(db: Session, user_id: int):
+    return db.query(models.User).filter(models.User.id == user_id).first()
+
+
+def get_user_profile_image(db: Session, user_id: int):
+    return (
+        db.query(models.User.user_profile_image)
+        .filter(models.User.id == user_id)
+        .scalar()
+    )
+
+
 def find_black_list_token(db: Session, token: str):
-    return db.query(models.BlackLists).filter(models.BlackLists.token == token).first()
+    return token_store.get_store().find(db, token)
+
+
+def get_users_by_emails(db: Session, emails: List[str]):
+    return db.query(models.User).filter(models.User.email.in_(emails)).all()
+
 
+def find_black_list_token_ids(db: Session, ids: List[str]):
+    return token_store.get_store().find_many(db, ids)
 
-def create_user(db: Session, user: schemas.UserIn):
+
+def get_black_list_tokens_since(db: Session, last_id: int):
+    return (
+        db.query(models.BlackLists)
+        .filter(models.BlackLists.id > last_id)
+        .order_by(models.BlackLists.id)
+        .all()
+    )
+
+
+async def create_user(db: Session, user: schemas.UserIn):
     new = user.dict()
-    hash = get_password_hash(user.dict()["password"])
+    hash = await hashing.hash_password(new["password"])
     new["hashed_password"] = hash
 
     del new["password"]
@@ -30,107 +60,191 @@ def create_user(db: Session, user: schemas.UserIn):
     db_dialogue.last_name = new["last_name"]
     db_dialogue.email = new["email"]
 
-    db.add(db_dialogue)
-    db.commit()
-    db.refresh(db_dialogue)
-
-    return db_dialogue
-
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return await run_in_threadpool(_save, db, db_dialogue)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+def _save(db: Session, instance):
+    db.add(instance)
+    db.commit()
+    db.refresh(instance)
+    return instance
 
 
-def authenticate_user(db, email: str, password: str):
-    user = get_user_by_email(db, email)
+async def authenticate_user(db, email: str, password: str):
+    user = await run_in_threadpool(get_user_by_email, db, email)
 
     if not user:
         return False
 
-    if not verify_password(password, user.hashed_password):
+    if not await hashing.verify_password(password, user.hashed_password):
         return False
 
     return user
 
 
-def update_password(password: str, db: Session, user: models.User):
-    hash = get_password_hash(password)
-    if pwd_context.verify(password, user.hashed_password):
+async def update_password(password: str, db: Session, user: models.User):
+    if await hashing.verify_password(password, user.hashed_password):
         raise HTTPException(
             status_code=409, detail="Old password and updated password are same."
         )
-    user.hashed_password = hash
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+    hashed_password = await hashing.hash_password(password)
+    await run_in_threadpool(_set_password, db, user.id, hashed_password)
+    user_cache.invalidate(user.email)
     return user
 
 
-def get_email_by_token(db: Session, token: str):
-    data = db.query(models.Codes).filter(models.Codes.reset_code == token).first()
-    return data.email
+def _set_password(db: Session, user_id: int, hashed_password: str):
+    db.query(models.User).filter(models.User.id == user_id).update(
+        {"hashed_password": hashed_password}
+    )
+    db.commit()
 
 
-def create_reset_code(db: Session, email: str, reset_code: str):
+def create_reset_code(
+    db: Session,
+    email: str,
+    reset_code: str,
+    outbox_email: models.EmailOutbox = None,
+):
     user_reset_code = models.Codes(
         email=email,
         reset_code=reset_code,
         expired_in=datetime.now() + timedelta(days=10),
     )
     db.add(user_reset_code)
+    # Commit the reset email with the code so neither exists without the other.
+    if outbox_email is not None:
+        db.add(outbox_email)
     db.commit()
     db.refresh(user_reset_code)
     return user_reset_code
 
 
+def claim_outbox_batch(db: Session, batch_size: int, max_attempts: int):
+    # Rows stay locked until finish_outbox_batch commits, and other
+    # workers skip them instead of waiting.
+    return (
+        db.query(models.EmailOutbox)
+        .filter(
+            models.EmailOutbox.sent_at.is_(None),
+            models.EmailOutbox.next_attempt_at <= datetime.utcnow(),
+            models.EmailOutbox.attempts < max_attempts,
+        )
+        .order_by(models.EmailOutbox.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+def finish_outbox_batch(db: Session):
+    db.commit()
+
+
+def delete_old_outbox_rows(db: Session, before: datetime, max_attempts: int):
+    # Sent rows and rows that will never be retried again.
+    result = db.execute(
+        delete(models.EmailOutbox)
+        .where(
+            models.EmailOutbox.created_at < before,
+            or_(
+                models.EmailOutbox.sent_at.isnot(None),
+                models.EmailOutbox.attempts >= max_attempts,
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount
+
+
+def count_undeliverable_outbox_rows(db: Session, max_attempts: int):
+    return (
+        db.query(models.EmailOutbox)
+        .filter(
+            models.EmailOutbox.sent_at.is_(None),
+            models.EmailOutbox.attempts >= max_attempts,
+        )
+        .count()
+    )
+
+
 def save_black_list_token(db: Session, token: str, email: str):
-    black_list_token = models.BlackLists(token=token, email=email)
-    db.add(black_list_token)
+    return token_store.get_store().save(db, token, email)
+
+
+def delete_expired_black_list_tokens(db: Session, batch_size: int):
+    expired = (
+        select(models.BlackLists.id)
+        .where(models.BlackLists.expires_at < datetime.utcnow())
+        .limit(batch_size)
+    )
+    result = db.execute(
+        delete(models.BlackLists)
+        .where(models.BlackLists.id.in_(expired))
+        .execution_options(synchronize_session=False)
+    )
     db.commit()
-    db.refresh(black_list_token)
-    return black_list_token
-
-
-def check_reset_token_validity(db: Session, token: str):
-    data = db.query(models.Codes).filter(models.Codes.reset_code == token).first()
-    if data:
-        if not data.active:
-            raise Exception("Token is not active.")
-        if data.expired_in < datetime.now():
-            raise Exception("Token has expired")
-        return data
-    raise Exception("No details found of password reset token.")
-
-
-def mark_token_inactive(db: Session, token: str):
-    data = db.query(models.Codes).filter(models.Codes.reset_code == token).first()
-    if not data:
-        raise Exception("No details found of password reset token.")
-    data.active = False
-    db.add(data)
+    return result.rowcount
+
+
+def consume_reset_code(db: Session, token: str):
+    # Validate and deactivate in one statement; the caller's next commit
+    # makes it stick, so a failed password update leaves the code usable.
+    statement = (
+        update(models.Codes)
+        .where(
+            models.Codes.reset_code == token,
+            models.Codes.active.is_(True),
+            models.Codes.expired_in > datetime.now(),
+        )
+        .values(active=False)
+        .execution_options(synchronize_session=False)
+    )
+    if db.get_bind(clause=statement).dialect.full_returning:
+        return db.execute(statement.returning(models.Codes.email)).scalar()
+
+    # Update first: it pins a routing session to the primary, so the email
+    # is read from there and not from a replica that may lag behind.
+    if not db.execute(statement).rowcount:
+        return None
+    return (
+        db.query(models.Codes.email).filter(models.Codes.reset_code == token).scalar()
+    )
+
+
+def delete_stale_reset_codes(db: Session):
+    result = db.execute(
+        delete(models.Codes)
+        .where(
+            or_(
+                models.Codes.active.is_(False),
+                models.Codes.expired_in < datetime.now(),
+            )
+        )
+        .execution_options(synchronize_session=False)
+    )
     db.commit()
-    db.refresh(data)
-    return data
+    return result.rowcount
 
 
 def update_user_profile(db: Session, user_data: schemas.UserBase, user):
 
-    db.query(models.User).filter(models.User.id == user.id).update(user_data)
+    db.query(models.User).filter(models.User.id == user.id).update(user_data.dict())
     db.commit()
+    user_cache.invalidate(user.email)
     return get_user_by_email(db, user_data.email)
 
 
-def upload_profile_image(db: Session, user_image):
-
-    db_profile_image = models.User(user_profile_image=user_image)
-    db.add(db_profile_image)
+def upload_profile_image(db: Session, user_id: int, user_image: str):
+    result = (
+        db.query(models.User)
+        .filter(models.User.id == user_id)
+        .update({"user_profile_image": user_image}, synchronize_session=False)
+    )
     db.commit()
-    db.refresh(db_profile_image)
-    return db_profile_image
+    user_cache.invalidate(user_id=user_id)
+    return result
 
 
 def delete_user_data(db: Session, user_id: int):
@@ -138,4 +252,62 @@ def delete_user_data(db: Session, user_id: int):
         db.query(models.User).filter(models.User.id == user_id).delete()
     )
     db.commit()
+    user_cache.invalidate(user_id=user_id)
     return db_delete_user_data
+
+
+def create_refresh_token(
+    db: Session, user_id: int, family: str, token_hash: str, expires_at: datetime
+):
+    db_refresh_token = models.RefreshToken(
+        token_hash=token_hash, user_id=user_id, family=family, expires_at=expires_at
+    )
+    db.add(db_refresh_token)
+    db.commit()
+    return db_refresh_token
+
+
+def use_refresh_token(db: Session, token_hash: str):
+    # Marks an active refresh token used and returns it. An already used token
+    # coming back means it leaked, so its whole family is revoked.
+    statement = (
+        update(models.RefreshToken)
+        .where(
+            models.RefreshToken.token_hash == token_hash,
+            models.RefreshToken.revoked.is_(False),
+            models.RefreshToken.expires_at > datetime.utcnow(),
+        )
+        .values(revoked=True)
+        .execution_options(synchronize_session=False)
+    )
+    used = db.execute(statement).rowcount
+    db_refresh_token = (
+        db.query(models.RefreshToken)
+        .filter(models.RefreshToken.token_hash == token_hash)
+        .first()
+    )
+    if not used and db_refresh_token is not None and db_refresh_token.revoked:
+        revoke_refresh_tokens(db, family=db_refresh_token.family)
+    db.commit()
+    return db_refresh_token if used else None
+
+
+def revoke_refresh_tokens(db: Session, family: str = None, user_id: int = None):
+    query = db.query(models.RefreshToken).filter(models.RefreshToken.revoked.is_(False))
+    if family is not None:
+        query = query.filter(models.RefreshToken.family == family)
+    if user_id is not None:
+        query = query.filter(models.RefreshToken.user_id == user_id)
+    revoked = query.update({"revoked": True}, synchronize_session=False)
+    db.commit()
+    return revoked
+
+
+def delete_expired_refresh_tokens(db: Session):
+    result = db.execute(
+        delete(models.RefreshToken)
+        .where(models.RefreshToken.expires_at < datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount
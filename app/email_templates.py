@@ -0,0 +1,40 @@
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+from jinja2 import Environment, FileSystemLoader, Template
+
+TEMPLATE_FOLDER = Path(__file__).resolve().parent / "templates"
+
+
+class TemplateRenderer:
+    # Compiles every template once. Jinja turns the static text of a template
+    # into constants of the compiled code, so a render only evaluates the
+    # placeholders; no per-message loader lookup, stat or parse.
+    def __init__(self, folder: Path = TEMPLATE_FOLDER):
+        self.environment = Environment(
+            loader=FileSystemLoader(str(folder)), auto_reload=False, cache_size=-1
+        )
+        self.templates: Dict[str, Template] = {}
+
+    def load(self):
+        self.templates = {
+            name: self.environment.get_template(name)
+            for name in self.environment.list_templates()
+        }
+
+    def get(self, name: str) -> Template:
+        template = self.templates.get(name)
+        if template is None:
+            template = self.templates[name] = self.environment.get_template(name)
+        return template
+
+    def render(self, name: str, body: dict) -> str:
+        return self.get(name).render(body=body)
+
+    def render_batch(self, name: str, bodies: Iterable[dict]) -> List[str]:
+        render = self.get(name).render
+        return [render(body=body) for body in bodies]
+
+
+renderer = TemplateRenderer()
+renderer.load()
@@ -0,0 +1,65 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+from . import metrics
+from .config import Settings
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+hash_queue_depth = metrics.gauge(
+    "hash_queue_depth", "Hashing jobs submitted to the pool and not yet finished."
+)
+hash_jobs = metrics.counter("hash_jobs_total", "Hashing jobs completed.")
+hash_latency = metrics.histogram(
+    "hash_latency_seconds", "Time from submitting a hashing job to its result."
+)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=Settings.HASH_POOL_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+# Plain functions executed inside the pool workers.
+def hash_password_sync(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password_sync(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+async def _run(func, *args):
+    hash_queue_depth.inc()
+    start = time.perf_counter()
+    try:
+        if Settings.HASH_POOL_WORKERS == 0:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), func, *args)
+    finally:
+        hash_queue_depth.dec()
+        hash_jobs.inc()
+        metrics.record(hash_latency, "bcrypt", time.perf_counter() - start)
+
+
+async def hash_password(password: str) -> str:
+    return await _run(hash_password_sync, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run(verify_password_sync, plain_password, hashed_password)
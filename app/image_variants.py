@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+from . import metrics
+from .config import Settings
+from .profile_images import absolute_path
+
+logger = logging.getLogger(__name__)
+
+variants_generated = metrics.counter(
+    "image_variants_generated_total", "Profile images resized into their variants."
+)
+variant_failures = metrics.counter(
+    "image_variant_failures_total", "Profile images that could not be resized."
+)
+variant_latency = metrics.histogram(
+    "image_variant_seconds", "Time to produce all variants of one profile image."
+)
+
+KNOWN_VARIANTS_MAX = 10000
+FAILED_SOURCES_MAX = 1000
+# A failure may be transient (a worker killed mid-resize), so retry later.
+FAILED_RETRY_SECONDS = 300
+
+_executor = None
+# Keeps scheduled jobs referenced until they finish, one per source image.
+_pending = {}
+# Variants seen on disk, most recently used last. Blobs are immutable, so
+# an entry never goes stale and pick() skips the filesystem for it.
+_known = OrderedDict()
+# Sources that could not be resized -> when they failed, oldest first. They
+# are served as the original until FAILED_RETRY_SECONDS have passed.
+_failed = OrderedDict()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=Settings.IMAGE_POOL_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def variant_path(relative_path: str, size: int) -> str:
+    return "{}.{}.webp".format(relative_path, size)
+
+
+# Executed inside the pool workers.
+def render_variants_sync(source: str, sizes: List[int]):
+    with Image.open(source) as original:
+        original.load()
+        for size in sizes:
+            destination = variant_path(source, size)
+            if os.path.exists(destination):
+                continue
+            image = original.copy()
+            image.thumbnail((size, size))
+            # A unique name, since another worker may be rendering the same
+            # blob; whichever rename lands last wins with a complete file.
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(destination), suffix=".tmp", delete=False
+            ) as temporary:
+                try:
+                    image.save(temporary, format="WEBP")
+                except BaseException:
+                    os.remove(temporary.name)
+                    raise
+            os.replace(temporary.name, destination)
+
+
+async def generate(relative_path: str):
+    start = time.perf_counter()
+    args = (absolute_path(relative_path), Settings.PROFILE_IMAGE_VARIANTS)
+    try:
+        if Settings.IMAGE_POOL_WORKERS == 0:
+            render_variants_sync(*args)
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(get_executor(), render_variants_sync, *args)
+    except Exception:
+        _failed[relative_path] = time.monotonic()
+        _failed.move_to_end(relative_path)
+        if len(_failed) > FAILED_SOURCES_MAX:
+            _failed.popitem(last=False)
+        variant_failures.inc()
+        logger.exception("Could not resize profile image %s", relative_path)
+        return
+    variants_generated.inc()
+    variant_latency.observe(time.perf_counter() - start)
+
+
+def has_failed(relative_path: str) -> bool:
+    failed_at = _failed.get(relative_path)
+    if failed_at is None:
+        return False
+    if time.monotonic() - failed_at < FAILED_RETRY_SECONDS:
+        return True
+    del _failed[relative_path]
+    return False
+
+
+def schedule(relative_path: str):
+    if relative_path in _pending or has_failed(relative_path):
+        return
+    task = asyncio.get_running_loop().create_task(generate(relative_path))
+    _pending[relative_path] = task
+    task.add_done_callback(lambda _: _pending.pop(relative_path, None))
+
+
+def _remember(variant: str):
+    _known[variant] = True
+    _known.move_to_end(variant)
+    if len(_known) > KNOWN_VARIANTS_MAX:
+        _known.popitem(last=False)
+
+
+async def pick(relative_path: str, requested: Optional[int]) -> Tuple[str, bool]:
+    # Smallest variant at least as large as requested, else the original.
+    # The flag is False while that variant is still being generated; one
+    # that is missing, say after a restart lost it, is generated again.
+    if requested is None:
+        return relative_path, True
+    for size in sorted(Settings.PROFILE_IMAGE_VARIANTS):
+        if size >= requested:
+            candidate = variant_path(relative_path, size)
+            if candidate in _known:
+                _known.move_to_end(candidate)
+                return candidate, True
+            if await run_in_threadpool(os.path.exists, absolute_path(candidate)):
+                _remember(candidate)
+                return candidate, True
+            if has_failed(relative_path):
+                return relative_path, True
+            schedule(relative_path)
+            return relative_path, False
+    return relative_path, True
@@ -0,0 +1,165 @@
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime
+
+from cryptography.hazmat.primitives import serialization
+from jose import JWTError, jwk, jwt
+
+# Every codec raises jose's JWTError for an invalid token, so callers do not
+# depend on the backend.
+
+
+class JoseCodec:
+    name = "jose"
+
+    def signing_key(self, material, algorithm: str):
+        return jwk.construct(material, algorithm)
+
+    def verification_key(self, material, algorithm: str):
+        key = jwk.construct(material, algorithm)
+        return key if algorithm.startswith("HS") else key.public_key()
+
+    def header(self, token: str) -> dict:
+        return jwt.get_unverified_header(token)
+
+    def encode(self, claims: dict, key, algorithm: str, headers: dict = None) -> str:
+        return jwt.encode(claims, key, algorithm=algorithm, headers=headers)
+
+    def decode(self, token: str, key, algorithm: str) -> dict:
+        return jwt.decode(token, key, algorithms=[algorithm])
+
+
+class PyJWTCodec:
+    name = "pyjwt"
+
+    def __init__(self):
+        import jwt as pyjwt
+
+        self.pyjwt = pyjwt
+
+    def signing_key(self, material, algorithm: str):
+        if algorithm.startswith("HS"):
+            return _as_bytes(material)
+        return serialization.load_pem_private_key(_as_bytes(material), password=None)
+
+    def verification_key(self, material, algorithm: str):
+        key = self.signing_key(material, algorithm)
+        return key if algorithm.startswith("HS") else key.public_key()
+
+    def header(self, token: str) -> dict:
+        try:
+            return self.pyjwt.get_unverified_header(token)
+        except self.pyjwt.PyJWTError as error:
+            raise JWTError(str(error))
+
+    def encode(self, claims: dict, key, algorithm: str, headers: dict = None) -> str:
+        return self.pyjwt.encode(claims, key, algorithm=algorithm, headers=headers)
+
+    def decode(self, token: str, key, algorithm: str) -> dict:
+        try:
+            return self.pyjwt.decode(token, key, algorithms=[algorithm])
+        except self.pyjwt.PyJWTError as error:
+            raise JWTError(str(error))
+
+
+class BuiltinHS256Codec:
+    # HS256 only. The key is an hmac object with the padded key blocks already
+    # absorbed, so each token costs a copy() instead of re-deriving them.
+    name = "builtin"
+
+    def signing_key(self, material, algorithm: str):
+        if algorithm != "HS256":
+            raise ValueError("The builtin JWT codec only supports HS256")
+        return hmac.new(_as_bytes(material), digestmod=hashlib.sha256)
+
+    verification_key = signing_key
+
+    def header(self, token: str) -> dict:
+        return _json_segment(token.split(".", 1)[0])
+
+    def encode(self, claims: dict, key, algorithm: str, headers: dict = None) -> str:
+        header = dict(headers or {}, alg="HS256", typ="JWT")
+        payload = {
+            name: _timestamp(value) if name in ("exp", "iat", "nbf") else value
+            for name, value in claims.items()
+        }
+        signing_input = (
+            _b64encode(_compact(header)) + b"." + _b64encode(_compact(payload))
+        )
+        mac = key.copy()
+        mac.update(signing_input)
+        return (signing_input + b"." + _b64encode(mac.digest())).decode()
+
+    def decode(self, token: str, key, algorithm: str) -> dict:
+        parts = token.encode().split(b".")
+        if len(parts) != 3:
+            raise JWTError("Not enough segments")
+        if self.header(token).get("alg") != "HS256":
+            raise JWTError("The specified alg value is not allowed")
+        mac = key.copy()
+        mac.update(parts[0] + b"." + parts[1])
+        if not hmac.compare_digest(mac.digest(), _b64decode(parts[2])):
+            raise JWTError("Signature verification failed.")
+        claims = _json_segment(parts[1])
+        now = time.time()
+        if "exp" in claims and not _number(claims["exp"]) > now:
+            raise JWTError("Signature has expired.")
+        if "nbf" in claims and _number(claims["nbf"]) > now:
+            raise JWTError("The token is not yet valid (nbf)")
+        return claims
+
+
+def _as_bytes(material) -> bytes:
+    return material.encode() if isinstance(material, str) else material
+
+
+def _compact(value: dict) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+def _number(value) -> float:
+    if not isinstance(value, (int, float)):
+        raise JWTError("Invalid time claim")
+    return value
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64decode(segment) -> bytes:
+    segment = _as_bytes(segment)
+    try:
+        return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+    except (TypeError, ValueError):
+        raise JWTError("Invalid segment padding")
+
+
+def _json_segment(segment) -> dict:
+    try:
+        value = json.loads(_b64decode(segment))
+    except ValueError:
+        raise JWTError("Invalid segment encoding")
+    if not isinstance(value, dict):
+        raise JWTError("Invalid segment encoding")
+    return value
+
+
+CODECS = {codec.name: codec for codec in (JoseCodec, PyJWTCodec, BuiltinHS256Codec)}
+
+
+def get_codec(name: str):
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError("Unknown JWT codec {!r}".format(name))
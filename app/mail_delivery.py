@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import aiosmtplib
+
+from . import metrics
+
+smtp_connections_opened = metrics.counter(
+    "smtp_connections_opened_total", "Authenticated SMTP sessions opened."
+)
+email_dispatch_latency = metrics.histogram(
+    "email_dispatch_seconds", "Time for the SMTP server to accept one message."
+)
+
+
+class SMTPConnectionPool:
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        username: str = None,
+        password: str = None,
+        use_tls: bool = False,
+        start_tls: bool = False,
+        validate_certs: bool = True,
+        size: int = 4,
+        idle_timeout: float = 60,
+    ):
+        self.options = {
+            "hostname": hostname,
+            "port": port,
+            "use_tls": use_tls,
+            "start_tls": start_tls,
+            "validate_certs": validate_certs,
+        }
+        self.username = username
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self._slots = asyncio.Semaphore(size)
+        # (released_at, connection), most recently used last
+        self._idle = []
+
+    async def acquire(self) -> aiosmtplib.SMTP:
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                released_at, smtp = self._idle.pop()
+                fresh = time.monotonic() - released_at < self.idle_timeout
+                if fresh and smtp.is_connected:
+                    return smtp
+                await self._close(smtp)
+            return await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, smtp: aiosmtplib.SMTP, healthy: bool = True):
+        if healthy and smtp.is_connected:
+            self._idle.append((time.monotonic(), smtp))
+        else:
+            await self._close(smtp)
+        self._slots.release()
+
+    async def close_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        stale = [smtp for released_at, smtp in self._idle if released_at < cutoff]
+        self._idle = [entry for entry in self._idle if entry[0] >= cutoff]
+        for smtp in stale:
+            await self._close(smtp)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, smtp in idle:
+            await self._close(smtp)
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        smtp = aiosmtplib.SMTP(**self.options)
+        await smtp.connect()
+        if self.username:
+            await smtp.login(self.username, self.password)
+        smtp_connections_opened.inc()
+        return smtp
+
+    async def _close(self, smtp: aiosmtplib.SMTP):
+        try:
+            if smtp.is_connected:
+                await smtp.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            smtp.close()
@@ -1,41 +1,73 @@
+import asyncio
+import hashlib
 import os
+import secrets
 import uuid
 from datetime import datetime, timedelta
 from typing import Optional
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import (
-    BackgroundTasks,
-    Depends,
-    FastAPI,
-    File,
-    HTTPException,
-    UploadFile,
-    status,
+from fastapi import Depends, FastAPI, File, HTTPException, Request, UploadFile, status
+from fastapi.responses import Response
+from fastapi.security import (
+    HTTPBasic,
+    HTTPBasicCredentials,
+    OAuth2PasswordBearer,
+    OAuth2PasswordRequestForm,
 )
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
+from jose import JWTError
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 
-from . import crud, models, schemas
-from .database import SessionLocal, engine
-from .send_email import send_email_background
+from . import (
+    admission,
+    async_crud,
+    crud,
+    database,
+    hashing,
+    image_variants,
+    maintenance,
+    metrics,
+    models,
+    outbox_worker,
+    profile_images,
+    query_profiler,
+    rate_limit,
+    request_metrics,
+    revocation,
+    schemas,
+    signing,
+    token_store,
+    upgrade_schema,
+)
+from .claims_cache import cache as claims_cache
+from .config import Settings
+from .database import engine, session_scope
+from .user_cache import CachedUser
+from .user_cache import cache as user_cache
+
+ACCESS_TOKEN_EXPIRE_MINUTES = Settings.ACCESS_TOKEN_EXPIRE_MINUTES
 
-# to get a string like this run:
-# openssl rand -hex 32
-SECRET_KEY = "edf57e1b178a0727356d496af85a1aa47caa82b9b22be4ab7c278c01ef30b827"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 100
+current_user_lookup = metrics.histogram(
+    "current_user_lookup_seconds",
+    "Database lookups of the authenticated user on a user cache miss.",
+)
 
 models.Base.metadata.create_all(bind=engine)
+upgrade_schema.check(engine)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+client_credentials = HTTPBasic(auto_error=False)
 
 app = FastAPI()
 
 origins = ["*"]
 
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(
+    profile_images.UploadLimitMiddleware, paths=["/api/v1/upload_profile_image"]
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -43,17 +75,53 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(query_profiler.QueryBudgetMiddleware)
+app.add_middleware(request_metrics.MetricsMiddleware, router=app.router)
 
 load_dotenv()
 
 
+@app.on_event("startup")
+async def warm_revocation_index():
+    await maintenance.sync_revocation_index()
+
+
+@app.on_event("startup")
+async def load_signing_keys():
+    # Fails startup when the keys cannot be loaded or created.
+    await run_in_threadpool(signing.keyring.load)
+
+
+@app.on_event("startup")
+async def start_maintenance():
+    maintenance.start()
+
+
+@app.on_event("startup")
+async def start_outbox_worker():
+    if Settings.OUTBOX_IN_PROCESS:
+        maintenance.tasks.append(asyncio.create_task(outbox_worker.run_forever()))
+
+
+@app.on_event("shutdown")
+async def stop_maintenance():
+    await maintenance.stop()
+
+
+@app.on_event("shutdown")
+def shutdown_hashing_pool():
+    hashing.shutdown_executor()
+
+
+@app.on_event("shutdown")
+def shutdown_image_pool():
+    image_variants.shutdown_executor()
+
+
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with session_scope() as db:
         yield db
-    finally:
-        db.close()
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -62,12 +130,12 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
+    encoded_jwt = signing.keyring.encode(to_encode)
     return encoded_jwt
 
 
-def get_current_user(
+async def get_current_user(
     db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
 ):
     credentials_exception = HTTPException(
@@ -76,7 +144,7 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = claims_cache.decode(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -84,37 +152,97 @@ def get_current_user(
     except JWTError:
         raise credentials_exception
 
-    # Check blacklist token
-    black_list_token = crud.find_black_list_token(db, token)
-    if black_list_token:
+    # Short-lived tokens are trusted until they expire; revocation is
+    # enforced when they are refreshed.
+    if Settings.TOKEN_MODE == "strict" and await revocation.is_revoked(db, token):
         raise credentials_exception
 
     # Check user existed
-    user = crud.get_user_by_email(db, email=token_data.username)
+    user = user_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
+        with metrics.timed(current_user_lookup, "db_user"):
+            db_user = await async_crud.run(
+                crud.get_user_by_email, db, email=token_data.username
+            )
+        if db_user is None:
+            raise credentials_exception
+        user = user_cache.put(db_user)
     return user
 
 
+def hash_refresh_token(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+async def issue_tokens(db: Session, user_id: int, email: str, family: str = None):
+    if Settings.TOKEN_MODE == "strict":
+        access_token = create_access_token(
+            data={"sub": email},
+            expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+        )
+        return {
+            "access_token": access_token,
+            "token_type": "bearer",
+            "user_id": user_id,
+        }
+
+    family = family or uuid.uuid4().hex
+    refresh_token = secrets.token_urlsafe(32)
+    await async_crud.run(
+        crud.create_refresh_token,
+        db,
+        user_id,
+        family,
+        hash_refresh_token(refresh_token),
+        datetime.utcnow() + timedelta(days=Settings.REFRESH_TOKEN_EXPIRE_DAYS),
+    )
+    access_token = create_access_token(
+        data={"sub": email, "sid": family},
+        expires_delta=timedelta(minutes=Settings.REFRESH_ACCESS_TOKEN_MINUTES),
+    )
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "user_id": user_id,
+        "refresh_token": refresh_token,
+    }
+
+
 def get_token_user(token: str = Depends(oauth2_scheme)):
     return token
 
 
 @app.post("/api/v1/register", response_model=schemas.UserOut)
 async def create_user(identity: schemas.UserIn, db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, identity.email)
+    user = await async_crud.run(crud.get_user_by_email, db, identity.email)
     if user:
         raise HTTPException(status_code=409, detail="Email already registered.")
-    return crud.create_user(db=db, user=identity)
+    return await async_crud.run(crud.create_user, db=db, user=identity)
 
 
 @app.post("/api/v1/login", response_model=schemas.Token)
 @app.post("/token", response_model=schemas.Token)
 async def login_for_access_token(
-    db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()
+    request: Request,
+    db: Session = Depends(get_db),
+    form_data: OAuth2PasswordRequestForm = Depends(),
 ):
-    user = crud.authenticate_user(
-        db=db, email=form_data.username, password=form_data.password
+    throttle = rate_limit.get_throttle()
+    retry_after = await throttle.admit(
+        form_data.username, rate_limit.client_ip(request)
+    )
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    user = await async_crud.run(
+        crud.authenticate_user,
+        db=db,
+        email=form_data.username,
+        password=form_data.password,
     )
 
     if not user:
@@ -124,90 +252,116 @@ async def login_for_access_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    await throttle.succeeded(form_data.username)
+    return await issue_tokens(db, user.id, user.email)
 
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+
+@app.post("/api/v1/refresh", response_model=schemas.Token)
+async def refresh_access_token(
+    request: schemas.RefreshRequest, db: Session = Depends(get_db)
+):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Refresh token is not valid",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    if Settings.TOKEN_MODE == "strict":
+        raise credentials_exception
+    used = await async_crud.run(
+        crud.use_refresh_token, db, hash_refresh_token(request.refresh_token)
     )
-    return {"access_token": access_token, "token_type": "bearer", "user_id": user.id}
+    if used is None:
+        raise credentials_exception
+    user = user_cache.get_by_id(used.user_id)
+    if user is None:
+        db_user = await async_crud.run(crud.get_user_by_id, db, used.user_id)
+        if db_user is None:
+            raise credentials_exception
+        user = user_cache.put(db_user)
+    return await issue_tokens(db, user.id, user.email, family=used.family)
 
 
-@app.get("/api/v1/me")
+@app.get("/api/v1/me", response_model=schemas.UserOut)
 async def get_logged_in_user(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: CachedUser = Depends(get_current_user),
 ):
     return current_user
 
 
 @app.put("/api/v1/update_password")
-def update_user_password(
+async def update_user_password(
     request: schemas.PasswordSchema,
     token: str = Depends(get_token_user),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: CachedUser = Depends(get_current_user),
 ):
     if request.password != request.re_password:
         raise HTTPException(
             status_code=409, detail="password and re_password does not match"
         )
 
-    crud.update_password(password=request.password, db=db, user=current_user)
-    crud.save_black_list_token(db, token, current_user.email)
+    await async_crud.run(
+        crud.update_password, password=request.password, db=db, user=current_user
+    )
+    await revocation.revoke(db, token, current_user.email)
+    await async_crud.run(crud.revoke_refresh_tokens, db, user_id=current_user.id)
     return {
         "message": "Password is updated Successfully. Please login again with updated password"
     }
 
 
 @app.post("/api/v1/forgot_password")
-def forget_password(
-    background_tasks: BackgroundTasks,
+async def forget_password(
     request: schemas.ForgetPasswordSchema,
     db: Session = Depends(get_db),
 ):
 
     # check user existed
-    result = crud.get_user_by_email(db, request.email)
+    result = await async_crud.run(crud.get_user_by_email, db, request.email)
     if not result:
         raise HTTPException(status_code=404, details="user not found.")
 
-    # Create reset code and save in database
+    # Create reset code and its email in one transaction; the outbox
+    # worker sends it. MAKE SURE .env FILE UPDATED
     reset_code = str(uuid.uuid1())
-    crud.create_reset_code(db, request.email, reset_code)
-
-    # MAKE SURE .env FILE UPDATED
-    send_email_background(
-        background_tasks,
-        "Password Reset",
-        request.email,
-        {
+    outbox_email = models.EmailOutbox(
+        recipient=request.email,
+        subject="Password Reset",
+        template="password_reset_email.html",
+        body={
             "protocol": os.getenv("PROTOCOL"),
             "domain": os.getenv("DOMAIN"),
             "url": "/reset_password?reset_password_token={0:}".format(reset_code),
         },
-        "password_reset_email.html",
+    )
+    await async_crud.run(
+        crud.create_reset_code, db, request.email, reset_code, outbox_email
     )
     message = "We've emailed you instructions for setting your password, if an account exists with the email you entered. You should receive them shortly. If you don't receive an email, please make sure you've entered the address you registered with, and check your spam folder."
     return {"status_code": status.HTTP_200_OK, "detail": message}
 
 
 @app.post("/api/v1/reset_password")
-def password_reset(request: schemas.ResetPasswordSchema, db: Session = Depends(get_db)):
-    # check token is valid or not
-    valid_token = crud.check_reset_token_validity(db, request.reset_password_token)
-    if not valid_token:
-        raise HTTPException(status_code=404, detail="Reset Token is not valid")
-
+async def password_reset(
+    request: schemas.ResetPasswordSchema, db: Session = Depends(get_db)
+):
     if request.new_password != request.confirm_password:
         raise HTTPException(
             status_code=409, detail="new_password and confirm_password does not match"
         )
 
-    # Update password
-    email = crud.get_email_by_token(db, request.reset_password_token)
-    user = crud.get_user_by_email(db, email)
-    crud.update_password(request.new_password, db, user)
-    crud.mark_token_inactive(db, request.reset_password_token)
+    # Validate and deactivate the token in one statement
+    email = await async_crud.run(
+        crud.consume_reset_code, db, request.reset_password_token
+    )
+    if not email:
+        raise HTTPException(status_code=404, detail="Reset Token is not valid")
+
+    # Update password, committing the token deactivation with it
+    user = await async_crud.run(crud.get_user_by_email, db, email)
+    await async_crud.run(crud.update_password, request.new_password, db, user)
+    await async_crud.run(crud.revoke_refresh_tokens, db, user_id=user.id)
     return {
         "status_code": status.HTTP_200_OK,
         "detail": "Password reset successfully. Please login.",
@@ -215,30 +369,33 @@ def password_reset(request: schemas.ResetPasswordSchema, db: Session = Depends(g
 
 
 @app.post("/api/v1/logout")
-def logout(
+async def logout(
     token: str = Depends(get_token_user),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: CachedUser = Depends(get_current_user),
 ):
-    crud.save_black_list_token(db, token, current_user.email)
+    await revocation.revoke(db, token, current_user.email)
+    family = token_store.unverified_claims(token).get("sid")
+    if family:
+        await async_crud.run(crud.revoke_refresh_tokens, db, family=family)
     return {"status_code": status.HTTP_200_OK, "detail": "User logged out successfully"}
 
 
 @app.put("/api/v1/profile_update")
-def update_user_profile(
+async def update_user_profile(
     user_data: schemas.UserBase,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: CachedUser = Depends(get_current_user),
 ):
-    crud.update_user_profile(db, user_data, current_user)
+    await async_crud.run(crud.update_user_profile, db, user_data, current_user)
     return {"status_code": status.HTTP_200_OK, "detail": "Profile updated successfully"}
 
 
 @app.delete("/api/v1/forget_me")
-def forget_me(
-    db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)
+async def forget_me(
+    db: Session = Depends(get_db), current_user: CachedUser = Depends(get_current_user)
 ):
-    crud.delete_user_data(db, user_id=current_user.id)
+    await async_crud.run(crud.delete_user_data, db, user_id=current_user.id)
     return {
         "status_code": status.HTTP_200_OK,
         "detail": "Your account is successfully deleted.",
@@ -246,37 +403,157 @@ def forget_me(
 
 
 @app.post("/api/v1/upload_profile_image")
-def upload_profile_image(
+async def upload_profile_image(
     db: Session = Depends(get_db),
     file: UploadFile = File(...),
-    current_user: models.User = Depends(get_current_user),
+    current_user: CachedUser = Depends(get_current_user),
 ):
-    cwd = os.getcwd()
-    path_image_dir = "upload-images/user-profile/" + str(current_user.id) + "/"
-    full_image_path = os.path.join(cwd, path_image_dir, file.filename)
-
-    # Create directory if not exist
-    if not os.path.exists(path_image_dir):
-        dir = os.path.join(cwd, "upload-images")
-        os.mkdir(dir)
-        dir = os.path.join(cwd, "upload-images", "user-profile")
-        os.mkdir(dir)
-        dir = os.path.join(cwd, "upload-images", "user-profile", str(current_user.id))
-        os.mkdir(dir)
-
-    # Rename file to "profile.png"
-    file_name = full_image_path.replace(file.filename, "profile.png")
+    try:
+        image_path = await profile_images.store_upload(file)
+    except profile_images.UploadTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="Profile image is larger than {} bytes".format(
+                Settings.PROFILE_IMAGE_MAX_BYTES
+            ),
+        )
 
     # Save file in user profile database
-    current_user.user_profile_image = file_name
-    crud.upload_profile_image(db, current_user.user_profile_image)
+    await async_crud.run(crud.upload_profile_image, db, current_user.id, image_path)
+    image_variants.schedule(image_path)
 
     return {
         "status_code": status.HTTP_200_OK,
         "detail": "Profile image upload success",
-        "profile_image": os.path.join(path_image_dir, "profile.png"),
+        "profile_image": image_path,
     }
 
 
+@app.get("/api/v1/users/{user_id}/profile_image")
+async def get_profile_image(
+    user_id: int,
+    request: Request,
+    size: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    image_path = await async_crud.run(crud.get_user_profile_image, db, user_id)
+    if image_path is None:
+        raise HTTPException(status_code=404, detail="Profile image not found")
+    image_path, ready = await image_variants.pick(image_path, size)
+    try:
+        # A stand-in original must not stay cached once the variant exists.
+        return await profile_images.serve(
+            image_path, request.headers, max_age=None if ready else 0
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Profile image not found")
+
+
+def require_introspection_client(
+    credentials: Optional[HTTPBasicCredentials] = Depends(client_credentials),
+):
+    secret = None
+    if credentials is not None:
+        secret = Settings.INTROSPECTION_CLIENTS.get(credentials.username)
+    if secret is None or not secrets.compare_digest(
+        credentials.password.encode(), secret.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid client credentials",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+
+
+@app.post(
+    "/api/v1/introspect",
+    response_model=schemas.IntrospectionResponse,
+    dependencies=[Depends(require_introspection_client)],
+)
+async def introspect(
+    request: schemas.IntrospectionRequest, db: Session = Depends(get_db)
+):
+    if len(request.tokens) > Settings.INTROSPECTION_MAX_TOKENS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="At most {} tokens per request".format(
+                Settings.INTROSPECTION_MAX_TOKENS
+            ),
+        )
+
+    # Verify each distinct token once, then resolve revocation and users
+    # for the whole batch with one query each.
+    claims_by_token = {}
+    for token in dict.fromkeys(request.tokens):
+        try:
+            claims = claims_cache.decode(token)
+        except JWTError:
+            continue
+        if claims.get("sub"):
+            claims_by_token[token] = claims
+
+    ids = {token: token_store.token_id(token) for token in claims_by_token}
+    revoked = await revocation.revoked_ids(db, list(set(ids.values())))
+
+    users = {}
+    missing = []
+    for email in {claims["sub"] for claims in claims_by_token.values()}:
+        user = user_cache.get(email)
+        if user is None:
+            missing.append(email)
+        else:
+            users[email] = user
+    if missing:
+        for db_user in await async_crud.run(crud.get_users_by_emails, db, missing):
+            users[db_user.email] = user_cache.put(db_user)
+
+    results = {}
+    for token, claims in claims_by_token.items():
+        user = users.get(claims["sub"])
+        if user is not None and ids[token] not in revoked:
+            results[token] = {"active": True, "user_id": user.id, "claims": claims}
+    inactive = {"active": False}
+    return {"results": [results.get(token, inactive) for token in request.tokens]}
+
+
+@app.get("/.well-known/jwks.json", include_in_schema=False)
+async def jwks(request: Request):
+    headers = {
+        "cache-control": "public, max-age={}".format(Settings.JWKS_MAX_AGE),
+        "etag": signing.keyring.jwks_etag,
+    }
+    if request.headers.get("if-none-match") == signing.keyring.jwks_etag:
+        return Response(status_code=304, headers=headers)
+    return Response(
+        signing.keyring.jwks, media_type="application/json", headers=headers
+    )
+
+
+def require_metrics_token(request: Request):
+    if not Settings.METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    expected = "Bearer " + Settings.METRICS_TOKEN
+    if not secrets.compare_digest(
+        request.headers.get("authorization", "").encode(), expected.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+@app.get(
+    "/metrics",
+    include_in_schema=False,
+    dependencies=[Depends(require_metrics_token)],
+)
+async def prometheus_metrics():
+    database.export_pool_status()
+    return Response(
+        metrics.render_prometheus(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from starlette.concurrency import run_in_threadpool
+
+from . import async_crud, crud, metrics, revocation, signing, token_store
+from .config import Settings
+from .database import session_scope
+
+logger = logging.getLogger(__name__)
+
+reset_codes_swept = metrics.counter(
+    "reset_codes_swept_total", "Expired or used password reset codes deleted."
+)
+
+refresh_tokens_swept = metrics.counter(
+    "refresh_tokens_swept_total", "Expired refresh tokens deleted."
+)
+
+blacklist_rows_purged = metrics.counter(
+    "blacklist_rows_purged_total", "Expired blacklist rows deleted by compaction."
+)
+blacklist_compaction_seconds = metrics.histogram(
+    "blacklist_compaction_seconds", "Wall time of one blacklist compaction run."
+)
+
+outbox_rows_purged = metrics.counter(
+    "outbox_rows_purged_total", "Sent or undeliverable outbox rows deleted."
+)
+outbox_undeliverable_rows = metrics.gauge(
+    "outbox_undeliverable_rows",
+    "Outbox rows that used up their attempts and will not be retried.",
+)
+
+tasks = []
+
+
+async def sweep_reset_codes():
+    async with session_scope() as db:
+        deleted = await async_crud.run(crud.delete_stale_reset_codes, db)
+    reset_codes_swept.inc(deleted)
+    return deleted
+
+
+async def sweep_refresh_tokens():
+    async with session_scope() as db:
+        deleted = await async_crud.run(crud.delete_expired_refresh_tokens, db)
+    refresh_tokens_swept.inc(deleted)
+    return deleted
+
+
+async def compact_blacklist(batch_size: int = None):
+    batch_size = batch_size or Settings.BLACKLIST_COMPACTION_BATCH
+    start = time.perf_counter()
+    purged = 0
+    async with session_scope() as db:
+        while True:
+            # Each batch commits on its own so locks are held only briefly.
+            deleted = await async_crud.run(
+                crud.delete_expired_black_list_tokens, db, batch_size
+            )
+            purged += deleted
+            if deleted < batch_size:
+                break
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    blacklist_rows_purged.inc(purged)
+    blacklist_compaction_seconds.observe(elapsed)
+    logger.info("Blacklist compaction purged %d rows in %.3fs", purged, elapsed)
+    return purged
+
+
+async def purge_outbox():
+    before = datetime.utcnow() - timedelta(days=Settings.OUTBOX_RETENTION_DAYS)
+    async with session_scope() as db:
+        deleted = await async_crud.run(
+            crud.delete_old_outbox_rows, db, before, Settings.OUTBOX_MAX_ATTEMPTS
+        )
+        undeliverable = await async_crud.run(
+            crud.count_undeliverable_outbox_rows, db, Settings.OUTBOX_MAX_ATTEMPTS
+        )
+    outbox_rows_purged.inc(deleted)
+    outbox_undeliverable_rows.set(undeliverable)
+    if undeliverable:
+        logger.warning("%d outbox emails could not be delivered", undeliverable)
+    return deleted
+
+
+async def sync_revocation_index():
+    if token_store.get_store().shared:
+        return
+    async with session_scope() as db:
+        await revocation.index.sync(db)
+
+
+async def reload_signing_keys():
+    # Picks up keys added by a rotation; file reads stay off the event loop.
+    await run_in_threadpool(signing.keyring.load)
+
+
+async def run_periodically(interval: float, job):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await job()
+        except Exception:
+            logger.exception("Periodic job %s failed", job.__name__)
+
+
+def start():
+    for interval, job in (
+        (Settings.RESET_CODE_SWEEP_SECONDS, sweep_reset_codes),
+        (Settings.RESET_CODE_SWEEP_SECONDS, sweep_refresh_tokens),
+        (Settings.BLACKLIST_COMPACTION_SECONDS, compact_blacklist),
+        (Settings.RESET_CODE_SWEEP_SECONDS, purge_outbox),
+        (Settings.JWT_KEYS_RELOAD_SECONDS, reload_signing_keys),
+        (Settings.REVOCATION_SYNC_SECONDS, sync_revocation_index),
+    ):
+        tasks.append(asyncio.create_task(run_periodically(interval, job)))
+
+
+async def stop():
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
@@ -0,0 +1,233 @@
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+registry = {}
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        cumulative, buckets = 0, {}
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        return {"count": count, "sum": total, "buckets": buckets}
+
+
+class Family:
+    # One child metric per combination of label values.
+    def __init__(
+        self, name: str, documentation: str, metric_class, labelnames, **kwargs
+    ):
+        self.metric_class = metric_class
+        self.kind = metric_class.kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.kwargs = kwargs
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self.metric_class(
+                        self.name, self.documentation, **self.kwargs
+                    )
+        return child
+
+    def snapshot(self):
+        return {
+            ",".join(values): child.snapshot()
+            for values, child in list(self.children.items())
+        }
+
+
+def _register(cls, name: str, documentation: str, **kwargs):
+    with _lock:
+        metric = registry.get(name)
+        if metric is None:
+            metric = registry[name] = cls(name, documentation, **kwargs)
+        return metric
+
+
+def counter(name: str, documentation: str) -> Counter:
+    return _register(Counter, name, documentation)
+
+
+def gauge(name: str, documentation: str) -> Gauge:
+    return _register(Gauge, name, documentation)
+
+
+def histogram(name: str, documentation: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, documentation, buckets=buckets)
+
+
+def counter_family(name: str, documentation: str, labelnames) -> Family:
+    return _register(
+        Family, name, documentation, metric_class=Counter, labelnames=labelnames
+    )
+
+
+def gauge_family(name: str, documentation: str, labelnames) -> Family:
+    return _register(
+        Family, name, documentation, metric_class=Gauge, labelnames=labelnames
+    )
+
+
+def histogram_family(
+    name: str, documentation: str, labelnames, buckets=DEFAULT_BUCKETS
+) -> Family:
+    return _register(
+        Family,
+        name,
+        documentation,
+        metric_class=Histogram,
+        labelnames=labelnames,
+        buckets=buckets,
+    )
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in registry.items()}
+
+
+# Phase durations of the request being served, for the Server-Timing header.
+# The middleware puts a fresh dict here per request; thread pool calls copy
+# the context and so add to the same dict.
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def timed(histogram: Histogram, phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(histogram, phase, time.perf_counter() - start)
+
+
+def record(histogram: Histogram, phase: str, seconds: float):
+    histogram.observe(seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def server_timing(timings: dict, total: float) -> str:
+    entries = [
+        "{};dur={:.2f}".format(phase, seconds * 1000)
+        for phase, seconds in timings.items()
+    ]
+    entries.append("total;dur={:.2f}".format(total * 1000))
+    return ", ".join(entries)
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(value)
+
+
+def _format_labels(pairs) -> str:
+    if not pairs:
+        return ""
+    escaped = (
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _render_sample(lines, name: str, metric, pairs):
+    if metric.kind != "histogram":
+        lines.append(name + _format_labels(pairs) + " " + _format_value(metric.value))
+        return
+    with metric._lock:
+        counts = list(metric.counts)
+        count, total = metric.count, metric.sum
+    cumulative = 0
+    for bound, bucket_count in zip(metric.buckets + (math.inf,), counts):
+        cumulative += bucket_count
+        le = pairs + (("le", _format_value(float(bound))),)
+        lines.append("{}_bucket{} {}".format(name, _format_labels(le), cumulative))
+    lines.append("{}_sum{} {}".format(name, _format_labels(pairs), repr(total)))
+    lines.append("{}_count{} {}".format(name, _format_labels(pairs), count))
+
+
+def render_prometheus() -> str:
+    # Prometheus text exposition format, version 0.0.4.
+    lines = []
+    for name, metric in sorted(registry.items()):
+        lines.append("# HELP {} {}".format(name, metric.documentation))
+        lines.append("# TYPE {} {}".format(name, metric.kind))
+        if isinstance(metric, Family):
+            for values, child in sorted(metric.children.items()):
+                _render_sample(
+                    lines, name, child, tuple(zip(metric.labelnames, values))
+                )
+        else:
+            _render_sample(lines, name, metric, ())
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,6 @@
-from sqlalchemy import Boolean, Column, DateTime, Integer, String
+from datetime import datetime
+
+from sqlalchemy import JSON, Boolean, Column, DateTime, Integer, String
 
 from .database import Base
 
@@ -29,7 +31,7 @@ class Codes(Base):
     __tablename__ = "codes"
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     email = Column(String)
-    reset_code = Column(String)
+    reset_code = Column(String, unique=True, index=True)
     active = Column(Boolean, default=True)
     expired_in = Column(DateTime)
 
@@ -37,5 +39,31 @@ class Codes(Base):
 class BlackLists(Base):
     __tablename__ = "blacklists"
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    token = Column(String, unique=True)
+    jti = Column(String, unique=True, index=True)
     email = Column(String)
+    expires_at = Column(DateTime, index=True)
+
+
+class EmailOutbox(Base):
+    __tablename__ = "email_outbox"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    recipient = Column(String)
+    subject = Column(String)
+    template = Column(String)
+    body = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, index=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    sent_at = Column(DateTime, nullable=True, index=True)
+
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    token_hash = Column(String, unique=True, index=True)
+    user_id = Column(Integer, index=True)
+    # Every rotation of one login shares a family, revoked together.
+    family = Column(String, index=True)
+    expires_at = Column(DateTime, index=True)
+    revoked = Column(Boolean, default=False)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+import aiosmtplib
+
+from . import async_crud, crud, metrics, models
+from .config import Settings
+from .database import engine, session_scope
+from .mail_delivery import SMTPConnectionPool, email_dispatch_latency
+from .send_email import Envs, build_message, smtp_options
+
+logger = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+outbox_sent = metrics.counter("outbox_sent_total", "Outbox emails delivered.")
+outbox_failed_attempts = metrics.counter(
+    "outbox_failed_attempts_total", "Outbox delivery attempts that failed."
+)
+outbox_lag = metrics.histogram(
+    "outbox_lag_seconds",
+    "Time from an outbox row being written to its email being sent.",
+    buckets=LAG_BUCKETS,
+)
+outbox_undeliverable = metrics.counter(
+    "outbox_undeliverable_total",
+    "Outbox emails given up on after OUTBOX_MAX_ATTEMPTS failed attempts.",
+)
+outbox_batch_throughput = metrics.gauge(
+    "outbox_batch_messages_per_second", "Delivery rate of the last outbox batch."
+)
+
+
+def record_failure(row: models.EmailOutbox, error: Exception):
+    row.attempts += 1
+    row.last_error = str(error)[:255] or type(error).__name__
+    row.next_attempt_at = datetime.utcnow() + timedelta(
+        seconds=Settings.OUTBOX_RETRY_BACKOFF * 2 ** (row.attempts - 1)
+    )
+    outbox_failed_attempts.inc()
+    if row.attempts >= Settings.OUTBOX_MAX_ATTEMPTS:
+        outbox_undeliverable.inc()
+        logger.error(
+            "Giving up on outbox email %s to %s after %d attempts: %s",
+            row.id,
+            row.recipient,
+            row.attempts,
+            row.last_error,
+        )
+
+
+async def send_row(pool: SMTPConnectionPool, row: models.EmailOutbox):
+    # Any error only fails this row, so the rest of the batch is still
+    # committed and the connection always goes back to the pool.
+    smtp, healthy = None, False
+    try:
+        message = build_message(row.subject, row.recipient, row.body, row.template)
+        smtp = await pool.acquire()
+        with metrics.timed(email_dispatch_latency, "email"):
+            await smtp.send_message(message)
+        healthy = True
+    except Exception as error:
+        if not isinstance(error, (aiosmtplib.SMTPException, OSError)):
+            logger.exception("Unexpected error sending outbox email %s", row.id)
+        record_failure(row, error)
+        return False
+    finally:
+        if smtp is not None:
+            await pool.release(smtp, healthy=healthy)
+
+    row.sent_at = datetime.utcnow()
+    outbox_sent.inc()
+    outbox_lag.observe((row.sent_at - row.created_at).total_seconds())
+    return True
+
+
+async def process_batch(db, pool: SMTPConnectionPool, batch_size: int = None) -> int:
+    rows = await async_crud.run(
+        crud.claim_outbox_batch,
+        db,
+        batch_size or Settings.OUTBOX_BATCH_SIZE,
+        Settings.OUTBOX_MAX_ATTEMPTS,
+    )
+    if not rows:
+        return 0
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(
+            *(send_row(pool, row) for row in rows), return_exceptions=True
+        )
+    finally:
+        # Commit whatever was sent, even if the batch was cancelled.
+        await async_crud.run(crud.finish_outbox_batch, db)
+    elapsed = time.perf_counter() - start
+
+    sent = sum(result is True for result in results)
+    outbox_batch_throughput.set(sent / elapsed if elapsed else 0.0)
+    logger.info("Outbox batch: sent %d of %d in %.3fs", sent, len(rows), elapsed)
+    return len(rows)
+
+
+def create_pool() -> SMTPConnectionPool:
+    return SMTPConnectionPool(
+        size=Envs.MAIL_POOL_SIZE, idle_timeout=Envs.MAIL_IDLE_TIMEOUT, **smtp_options
+    )
+
+
+async def run_forever():
+    pool = create_pool()
+    try:
+        while True:
+            try:
+                async with session_scope() as db:
+                    claimed = await process_batch(db, pool)
+            except Exception:
+                logger.exception("Outbox batch failed")
+                claimed = 0
+            # A full batch means more rows are probably waiting.
+            if claimed < Settings.OUTBOX_BATCH_SIZE:
+                await asyncio.sleep(Settings.OUTBOX_POLL_SECONDS)
+                await pool.close_idle()
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    models.Base.metadata.create_all(bind=engine)
+    asyncio.run(run_forever())
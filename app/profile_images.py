@@ -0,0 +1,287 @@
+import hashlib
+import os
+import tempfile
+from typing import Mapping, Optional, Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import Settings
+
+# Ranges up to this size are read in one thread pool call, as the whole file
+# used to be; larger ones are sent in chunks of this size.
+SEND_CHUNK_SIZE = 1024 * 1024
+# Allowance for the multipart boundaries and part headers around the file.
+MULTIPART_OVERHEAD = 16 * 1024
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadLimitMiddleware:
+    # Starlette spools the whole multipart body to disk before the endpoint
+    # runs, so oversized uploads are refused here instead: by Content-Length
+    # up front, or as soon as a chunked body passes the limit.
+    def __init__(self, app: ASGIApp, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        limit = Settings.PROFILE_IMAGE_MAX_BYTES + MULTIPART_OVERHEAD
+        content_length = Headers(scope=scope).get("content-length", "")
+        if content_length.isdigit() and int(content_length) > limit:
+            await self.reject(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise UploadTooLarge()
+            return message
+
+        async def guarded_send(message: Message):
+            # The form parser reports the abort as a 400; send 413 instead.
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadTooLarge:
+            pass
+        if exceeded:
+            await self.reject(scope, receive, send)
+
+    async def reject(self, scope: Scope, receive: Receive, send: Send):
+        response = JSONResponse(
+            {
+                "detail": "Profile image is larger than {} bytes".format(
+                    Settings.PROFILE_IMAGE_MAX_BYTES
+                )
+            },
+            status_code=413,
+            headers={"Connection": "close"},
+        )
+        await response(scope, receive, send)
+
+
+def blob_path(digest: str) -> str:
+    # Relative to PROFILE_IMAGE_DIR; this is what the user row stores.
+    return os.path.join("objects", digest[:2], digest)
+
+
+def absolute_path(relative_path: str) -> str:
+    return os.path.join(Settings.PROFILE_IMAGE_DIR, relative_path)
+
+
+def _open_temporary():
+    directory = os.path.join(Settings.PROFILE_IMAGE_DIR, "tmp")
+    os.makedirs(directory, exist_ok=True)
+    # Same filesystem as the blobs, so the final rename is atomic.
+    return tempfile.NamedTemporaryFile(dir=directory, delete=False)
+
+
+def _commit(temporary_path: str, digest: str) -> str:
+    relative_path = blob_path(digest)
+    destination = absolute_path(relative_path)
+    if os.path.exists(destination):
+        # Same bytes are already stored; the duplicate costs nothing.
+        os.remove(temporary_path)
+    else:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(temporary_path, destination)
+    return relative_path
+
+
+async def store_upload(file: UploadFile) -> str:
+    # Only one chunk is held in memory at a time, whatever the upload size.
+    output = await run_in_threadpool(_open_temporary)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = await file.read(Settings.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > Settings.PROFILE_IMAGE_MAX_BYTES:
+                raise UploadTooLarge()
+            digest.update(chunk)
+            await run_in_threadpool(output.write, chunk)
+        await run_in_threadpool(output.close)
+        return await run_in_threadpool(_commit, output.name, digest.hexdigest())
+    except BaseException:
+        await run_in_threadpool(output.close)
+        await run_in_threadpool(os.remove, output.name)
+        raise
+
+
+def media_type(header: bytes) -> str:
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, name in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return name
+    return "application/octet-stream"
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    # A single "bytes=" range as an inclusive (start, end). None means serve
+    # the whole file, ValueError means the range cannot be satisfied.
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash or not (first or last):
+        return None
+    try:
+        if not first:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError(value)
+    return start, end
+
+
+def _read_range(path: str, start: int, count: int) -> bytes:
+    with open(path, "rb") as file:
+        file.seek(start)
+        return file.read(count)
+
+
+class FileRangeResponse(Response):
+    # Sends part of a file. Servers implementing the ASGI zero-copy extension
+    # get the file descriptor for sendfile(). Others, uvicorn included, get
+    # one read on the thread pool, or SEND_CHUNK_SIZE chunks for large ranges.
+    def __init__(
+        self,
+        path: str,
+        start: int,
+        end: int,
+        status_code: int,
+        headers: Mapping[str, str],
+        media_type: str,
+    ):
+        self.path = path
+        self.start = start
+        self.count = end - start + 1
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(dict(headers, **{"content-length": str(self.count)}))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        zerocopy = "http.response.zerocopy" in scope.get("extensions", {})
+        body = None
+        if not zerocopy and self.count <= SEND_CHUNK_SIZE:
+            body = await run_in_threadpool(
+                _read_range, self.path, self.start, self.count
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if body is not None:
+            await send({"type": "http.response.body", "body": body})
+            return
+        with await run_in_threadpool(open, self.path, "rb") as file:
+            if zerocopy:
+                await send(
+                    {
+                        "type": "http.response.zerocopy",
+                        "file": file,
+                        "offset": self.start,
+                        "count": self.count,
+                    }
+                )
+                return
+            await run_in_threadpool(file.seek, self.start)
+            remaining = self.count
+            while remaining:
+                chunk = await run_in_threadpool(
+                    file.read, min(SEND_CHUNK_SIZE, remaining)
+                )
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison (RFC 7232, 3.2): W/ prefixes are
+    # ignored on both sides, and "*" matches any current representation.
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+
+def _inspect(path: str) -> Tuple[int, bytes]:
+    with open(path, "rb") as file:
+        return os.fstat(file.fileno()).st_size, file.read(16)
+
+
+async def serve(
+    relative_path: str, request_headers: Mapping[str, str], max_age: int = None
+) -> Response:
+    # Blobs are named by their sha256, which makes a strong ETag for free.
+    etag = '"{}"'.format(os.path.basename(relative_path))
+    headers = {
+        "etag": etag,
+        "cache-control": "public, max-age={}".format(
+            Settings.PROFILE_IMAGE_MAX_AGE if max_age is None else max_age
+        ),
+        "accept-ranges": "bytes",
+    }
+    if etag_matches(request_headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    path = absolute_path(relative_path)
+    size, header = await run_in_threadpool(_inspect, path)
+    start, end, status_code = 0, size - 1, 200
+    range_header = request_headers.get("range")
+    if range_header and request_headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            headers["content-range"] = "bytes */{}".format(size)
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["content-range"] = "bytes {}-{}/{}".format(start, end, size)
+    return FileRangeResponse(path, start, end, status_code, headers, media_type(header))
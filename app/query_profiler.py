@@ -0,0 +1,128 @@
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from . import metrics
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+db_query_latency = metrics.histogram(
+    "db_query_seconds", "Time to execute one SQL statement.", buckets=QUERY_BUCKETS
+)
+db_queries_per_request = metrics.histogram(
+    "db_queries_per_request",
+    "SQL statements executed while serving one request.",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50),
+)
+db_over_budget = metrics.counter(
+    "db_query_budget_exceeded_total",
+    "Requests that ran more SQL statements or SQL time than the budget allows.",
+)
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.commits = 0
+        self.seconds = 0.0
+        self.statements = []
+
+    def add(self, other: "QueryStats"):
+        self.count += other.count
+        self.commits += other.commits
+        self.seconds += other.seconds
+        self.statements.extend(other.statements)
+
+
+current = contextvars.ContextVar("query_stats", default=None)
+
+
+@contextmanager
+def profile():
+    # Statements run inside the block, including on the thread pool and in
+    # AsyncSession greenlets, which both copy the context. A nested profile
+    # adds its totals to the enclosing one when it ends.
+    parent = current.get()
+    stats = QueryStats()
+    token = current.set(stats)
+    try:
+        yield stats
+    finally:
+        current.reset(token)
+        if parent is not None:
+            parent.add(stats)
+
+
+# Registered on the Engine class, so every engine is covered: the primary,
+# the replicas, the sync side of the async engine and the tests' own engine.
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    metrics.record(db_query_latency, "db", elapsed)
+    stats = current.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+        stats.statements.append(statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    # A statement that fails never reaches after_cursor_execute.
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+@event.listens_for(Engine, "commit")
+def on_commit(conn):
+    stats = current.get()
+    if stats is not None:
+        stats.commits += 1
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            with profile() as stats:
+                await self.app(scope, receive, send)
+        finally:
+            self.report(scope, stats)
+
+    def report(self, scope: Scope, stats: QueryStats):
+        db_queries_per_request.observe(stats.count)
+        if (
+            stats.count > Settings.SQL_QUERY_BUDGET
+            or stats.seconds * 1000 > Settings.SQL_TIME_BUDGET_MS
+        ):
+            db_over_budget.inc()
+            logger.warning(
+                "%s %s ran %d queries and %d commits in %.1f ms "
+                "(budget %d queries, %d ms)",
+                scope["method"],
+                scope["path"],
+                stats.count,
+                stats.commits,
+                stats.seconds * 1000,
+                Settings.SQL_QUERY_BUDGET,
+                Settings.SQL_TIME_BUDGET_MS,
+            )
@@ -0,0 +1,240 @@
+import ipaddress
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import redis
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from . import metrics
+from .config import Settings
+
+login_throttled = metrics.counter(
+    "login_throttled_total", "Login attempts rejected before password verification."
+)
+
+
+def _wait_seconds(
+    count: int,
+    oldest: float,
+    newest: float,
+    now: float,
+    window: float,
+    limit: int,
+    backoff: Optional[Tuple[float, float]],
+) -> float:
+    # Seconds until one more attempt fits, given the attempts in the window.
+    # With backoff=(base, cap), each attempt past the limit doubles the wait
+    # after the newest one instead of waiting for the oldest to age out.
+    if count < limit:
+        return 0.0
+    if backoff is None:
+        return oldest + window - now
+    base, cap = backoff
+    return newest + min(cap, base * 2 ** (count - limit)) - now
+
+
+class MemoryWindowStore:
+    # Per-process; each worker counts only the attempts it served.
+    blocking = False
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> timestamps inside the window, oldest first
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def acquire(
+        self,
+        key: str,
+        window: float,
+        limit: int,
+        backoff: Optional[Tuple[float, float]] = None,
+    ) -> float:
+        # Records an attempt unless the key is over its limit, in one step.
+        # Returns 0 if it was recorded, else the seconds to wait.
+        now = time.time()
+        with self._lock:
+            stamps = self._prune(key, now - window)
+            if stamps:
+                wait = _wait_seconds(
+                    len(stamps), stamps[0], stamps[-1], now, window, limit, backoff
+                )
+                if wait > 0:
+                    return wait
+            else:
+                if len(self.entries) >= self.max_keys:
+                    self._sweep(now - window)
+                stamps = self.entries[key] = deque()
+            stamps.append(now)
+            return 0.0
+
+    def reset(self, key: str):
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def _prune(self, key: str, cutoff: float) -> Optional[deque]:
+        stamps = self.entries.get(key)
+        if stamps is None:
+            return None
+        while stamps and stamps[0] <= cutoff:
+            stamps.popleft()
+        if not stamps:
+            del self.entries[key]
+            return None
+        return stamps
+
+    def _sweep(self, cutoff: float):
+        for key in [
+            key for key, stamps in self.entries.items() if stamps[-1] <= cutoff
+        ]:
+            del self.entries[key]
+
+
+# The same check-and-record as MemoryWindowStore.acquire, run inside Redis so
+# parallel attempts on different workers cannot all see the old count.
+ACQUIRE_SCRIPT = """
+local now, window, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local base, cap = tonumber(ARGV[4]), tonumber(ARGV[5])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], 0, now - window)
+local count = redis.call("ZCARD", KEYS[1])
+if count >= limit then
+    local wait
+    if base > 0 then
+        local newest = redis.call("ZRANGE", KEYS[1], -1, -1, "WITHSCORES")
+        wait = newest[2] + math.min(cap, base * 2 ^ (count - limit)) - now
+    else
+        local oldest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+        wait = oldest[2] + window - now
+    end
+    if wait > 0 then
+        return tostring(wait)
+    end
+end
+redis.call("ZADD", KEYS[1], now, ARGV[6])
+redis.call("EXPIRE", KEYS[1], math.ceil(window))
+return "0"
+"""
+
+
+class RedisWindowStore:
+    # Shared by every worker. Each key is a sorted set of attempt timestamps.
+    blocking = True
+
+    def __init__(self, client: redis.Redis, prefix: str = "throttle:"):
+        self.client = client
+        self.prefix = prefix
+        self._acquire = client.register_script(ACQUIRE_SCRIPT)
+
+    def acquire(
+        self,
+        key: str,
+        window: float,
+        limit: int,
+        backoff: Optional[Tuple[float, float]] = None,
+    ) -> float:
+        base, cap = backoff or (0, 0)
+        # Lua numbers come back from Redis truncated to integers, hence the
+        # string reply.
+        wait = self._acquire(
+            keys=[self.prefix + key],
+            args=[time.time(), window, limit, base, cap, uuid.uuid4().hex],
+        )
+        return float(wait)
+
+    def reset(self, key: str):
+        self.client.delete(self.prefix + key)
+
+
+class LoginThrottle:
+    # Runs before bcrypt so rejected attempts cost a few dict operations or
+    # one Redis script call per key. Each check records the attempt in the
+    # same step, so parallel guesses on any number of workers are limited
+    # before any of them is hashed. An attempt within the IP limit counts
+    # against the IP; one the email also admits counts against the email
+    # until a login succeeds. Past the limit each further failure doubles the
+    # lockout.
+    def __init__(self, store):
+        self.store = store
+
+    async def _call(self, func, *args):
+        if self.store.blocking:
+            return await run_in_threadpool(func, *args)
+        return func(*args)
+
+    def _admit(self, email: str, ip: str) -> float:
+        wait = self.store.acquire(
+            "ip:" + ip, Settings.LOGIN_IP_WINDOW_SECONDS, Settings.LOGIN_IP_LIMIT
+        )
+        if wait <= 0:
+            wait = self.store.acquire(
+                "email:" + email,
+                Settings.LOGIN_FAILURE_WINDOW_SECONDS,
+                Settings.LOGIN_FAILURE_LIMIT,
+                (
+                    Settings.LOGIN_LOCKOUT_BASE_SECONDS,
+                    Settings.LOGIN_LOCKOUT_MAX_SECONDS,
+                ),
+            )
+        if wait > 0:
+            login_throttled.inc()
+        return wait
+
+    async def admit(self, email: str, ip: str) -> int:
+        # Seconds to wait before retrying, or 0 if the attempt may proceed.
+        retry_after = await self._call(self._admit, email.strip().lower(), ip)
+        return math.ceil(retry_after)
+
+    async def succeeded(self, email: str):
+        await self._call(self.store.reset, "email:" + email.strip().lower())
+
+
+@lru_cache(maxsize=None)
+def _networks(proxies: Tuple[str, ...]):
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def _trusted(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in net for net in _networks(tuple(Settings.TRUSTED_PROXIES)))
+
+
+def client_ip(request: Request) -> str:
+    # Behind TRUSTED_PROXIES the peer is the proxy, so walk X-Forwarded-For
+    # from the nearest hop to the first address that is not one of ours.
+    host = request.client.host if request.client else "unknown"
+    if not _trusted(host):
+        return host
+    forwarded = request.headers.get("x-forwarded-for", "")
+    for hop in reversed([hop.strip() for hop in forwarded.split(",") if hop.strip()]):
+        if not _trusted(hop):
+            return hop
+        host = hop
+    return host
+
+
+throttle = None
+
+
+def get_throttle() -> LoginThrottle:
+    global throttle
+    if throttle is None:
+        if Settings.LOGIN_THROTTLE_STORE == "redis":
+            store = RedisWindowStore(redis.Redis.from_url(Settings.REDIS_URL))
+        else:
+            store = MemoryWindowStore()
+        throttle = LoginThrottle(store)
+    return throttle
+
+
+def set_throttle(new_throttle: Optional[LoginThrottle]):
+    global throttle
+    throttle = new_throttle
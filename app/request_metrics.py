@@ -0,0 +1,70 @@
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match, Router
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import metrics
+from .config import Settings
+
+http_requests = metrics.counter_family(
+    "http_requests_total",
+    "Requests served, by route template and status code.",
+    ("method", "route", "status"),
+)
+http_request_duration = metrics.histogram_family(
+    "http_request_duration_seconds",
+    "Time from receiving a request to finishing its response, by route template.",
+    ("method", "route"),
+)
+
+
+def route_label(router: Router, scope: Scope) -> str:
+    # The route template rather than the raw path, so /users/{user_id}/...
+    # is one series however many users there are.
+    partial = None
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp, router: Router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings = {}
+        token = metrics.request_timings.set(timings)
+        status_code = 500
+
+        async def send_with_timing(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if Settings.SERVER_TIMING:
+                    headers = MutableHeaders(scope=message)
+                    headers.append(
+                        "Server-Timing",
+                        metrics.server_timing(timings, time.perf_counter() - start),
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            metrics.request_timings.reset(token)
+            route = route_label(self.router, scope)
+            http_requests.labels(scope["method"], route, str(status_code)).inc()
+            http_request_duration.labels(scope["method"], route).observe(
+                time.perf_counter() - start
+            )
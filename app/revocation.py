@@ -0,0 +1,174 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import timezone
+from typing import List, Set
+
+from sqlalchemy.orm import Session
+
+from . import async_crud, crud, metrics, token_store
+from .claims_cache import cache as claims_cache
+from .config import Settings
+from .token_store import token_expiry, token_id
+
+revocation_lookups = metrics.counter(
+    "revocation_lookups_total", "Revocation checks made by authenticated requests."
+)
+revocation_filter_skips = metrics.counter(
+    "revocation_filter_skips_total",
+    "Revocation checks answered by the filter without a database query.",
+)
+revocation_db_checks = metrics.counter(
+    "revocation_db_checks_total", "Revocation checks that had to query the database."
+)
+revocation_false_positives = metrics.counter(
+    "revocation_false_positives_total",
+    "Database checks where the filter said maybe but the token was not revoked.",
+)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RevocationIndex:
+    def __init__(
+        self,
+        capacity: int = Settings.REVOCATION_FILTER_CAPACITY,
+        error_rate: float = Settings.REVOCATION_FILTER_ERROR_RATE,
+    ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filter = BloomFilter(capacity, error_rate)
+        # token id -> epoch seconds at which the token expires
+        self.revoked = {}
+        self.last_row_id = 0
+        self._lock = threading.Lock()
+
+    def add(self, token: str):
+        self.add_id(token_id(token), token_expiry(token))
+
+    def add_id(self, key: str, expires_at: float):
+        with self._lock:
+            if self.filter.count >= self.capacity:
+                self._rebuild()
+            self.filter.add(key)
+            if expires_at > time.time():
+                self.revoked[key] = expires_at
+
+    def _rebuild(self):
+        # Bloom filters cannot forget, so start over from the live TTL set.
+        now = time.time()
+        self.revoked = {k: exp for k, exp in self.revoked.items() if exp > now}
+        self.filter = BloomFilter(self.capacity, self.error_rate)
+        for key in self.revoked:
+            self.filter.add(key)
+
+    async def sync(self, db: Session):
+        # Picks up logouts made on other workers. Run at startup and then every
+        # REVOCATION_SYNC_SECONDS by the maintenance task, never on a request.
+        # Ids are not committed in order across workers, so each pass re-reads
+        # the last REVOCATION_SYNC_LOOKBACK rows in case a lower id landed late.
+        with self._lock:
+            since = max(0, self.last_row_id - Settings.REVOCATION_SYNC_LOOKBACK)
+        rows = await async_crud.run(crud.get_black_list_tokens_since, db, since)
+        now = time.time()
+        last_row_id = since
+        for row in rows:
+            last_row_id = max(last_row_id, row.id)
+            expires_at = row.expires_at.replace(tzinfo=timezone.utc).timestamp()
+            with self._lock:
+                seen = row.jti in self.revoked
+            if not seen and expires_at > now:
+                self.add_id(row.jti, expires_at)
+        with self._lock:
+            self.last_row_id = max(self.last_row_id, last_row_id)
+
+    async def is_revoked(self, db: Session, token: str) -> bool:
+        revocation_lookups.inc()
+        key = token_id(token)
+        with self._lock:
+            if key in self.revoked:
+                return True
+            maybe = key in self.filter
+        if not maybe:
+            revocation_filter_skips.inc()
+            return False
+
+        revocation_db_checks.inc()
+        if await async_crud.run(crud.find_black_list_token, db, token):
+            self.add(token)
+            return True
+        revocation_false_positives.inc()
+        return False
+
+    async def revoked_ids(self, db: Session, ids: List[str]) -> Set[str]:
+        revocation_lookups.inc(len(ids))
+        with self._lock:
+            revoked = {key for key in ids if key in self.revoked}
+            maybe = [key for key in ids if key not in revoked and key in self.filter]
+        revocation_filter_skips.inc(len(ids) - len(revoked) - len(maybe))
+        if maybe:
+            revocation_db_checks.inc(len(maybe))
+            found = await async_crud.run(crud.find_black_list_token_ids, db, maybe)
+            revocation_false_positives.inc(len(maybe) - len(found))
+            revoked |= found
+        return revoked
+
+    def stats(self):
+        lookups = revocation_lookups.value
+        db_checks = revocation_db_checks.value
+        return {
+            "lookups": lookups,
+            "revoked_tokens": len(self.revoked),
+            "hit_rate": revocation_filter_skips.value / lookups if lookups else 0.0,
+            "false_positive_rate": (
+                revocation_false_positives.value / db_checks if db_checks else 0.0
+            ),
+        }
+
+
+index = RevocationIndex()
+
+
+async def is_revoked(db: Session, token: str) -> bool:
+    if token_store.get_store().shared:
+        revocation_lookups.inc()
+        return bool(await async_crud.run(crud.find_black_list_token, db, token))
+    return await index.is_revoked(db, token)
+
+
+async def revoked_ids(db: Session, ids: List[str]) -> Set[str]:
+    # Batch form of is_revoked over token ids, with at most one query.
+    if token_store.get_store().shared:
+        revocation_lookups.inc(len(ids))
+        return await async_crud.run(crud.find_black_list_token_ids, db, ids)
+    return await index.revoked_ids(db, ids)
+
+
+async def revoke(db: Session, token: str, email: str):
+    await async_crud.run(crud.save_black_list_token, db, token, email)
+    index.add(token)
+    claims_cache.evict(token)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, EmailStr
 
@@ -22,6 +22,7 @@ class UserOut(UserBase):
 
     first_name: Optional[str] = None
     last_name: Optional[str] = None
+    user_profile_image: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -46,6 +47,11 @@ class Token(BaseModel):
     access_token: str
     token_type: str
     user_id: int
+    refresh_token: Optional[str] = None
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
@@ -74,3 +80,17 @@ class ResetPasswordSchema(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class IntrospectionRequest(BaseModel):
+    tokens: List[str]
+
+
+class IntrospectionResult(BaseModel):
+    active: bool
+    user_id: Optional[int] = None
+    claims: Optional[dict] = None
+
+
+class IntrospectionResponse(BaseModel):
+    results: List[IntrospectionResult]
@@ -1,8 +1,10 @@
 import os
+from email.message import EmailMessage
 
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks
-from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
+from fastapi_mail import ConnectionConfig
+
+from .email_templates import renderer
 
 load_dotenv()
 
@@ -13,10 +15,10 @@ class Envs:
     MAIL_FROM = os.getenv("MAIL_FROM", "test@test.com")
     MAIL_PORT = int(os.getenv("MAIL_PORT", 1025))
     MAIL_SERVER = os.getenv("MAIL_SERVER", "smtp.gmail.com")
+    MAIL_POOL_SIZE = int(os.getenv("MAIL_POOL_SIZE", 4))
+    MAIL_IDLE_TIMEOUT = float(os.getenv("MAIL_IDLE_TIMEOUT", 60))
 
 
-template_folder = os.getcwd()
-
 conf = ConnectionConfig(
     MAIL_USERNAME=Envs.MAIL_USERNAME,
     MAIL_PASSWORD=Envs.MAIL_PASSWORD,
@@ -26,37 +28,26 @@ conf = ConnectionConfig(
     MAIL_TLS=True,
     MAIL_SSL=False,
     USE_CREDENTIALS=True,
-    TEMPLATE_FOLDER="./app/templates",
 )
 
 
-async def send_email_async(subject: str, email_to: str, body: dict, template: str):
-    message = MessageSchema(
-        subject=subject,
-        recipients=[email_to],
-        template_body=body,
-        subtype="html",
-    )
-
-    fm = FastMail(conf)
-
-    await fm.send_message(message, template_name=template)
-
-
-def send_email_background(
-    background_tasks: BackgroundTasks,
-    subject: str,
-    email_to: str,
-    body: dict,
-    template: str,
-):
-    message = MessageSchema(
-        subject=subject,
-        recipients=[email_to],
-        template_body=body,
-        subtype="html",
-    )
+smtp_options = dict(
+    hostname=conf.MAIL_SERVER,
+    port=conf.MAIL_PORT,
+    username=conf.MAIL_USERNAME if conf.USE_CREDENTIALS else None,
+    password=conf.MAIL_PASSWORD,
+    use_tls=conf.MAIL_SSL,
+    start_tls=conf.MAIL_TLS,
+    validate_certs=conf.VALIDATE_CERTS,
+)
 
-    fm = FastMail(conf)
 
-    background_tasks.add_task(fm.send_message, message, template_name=template)
+def build_message(
+    subject: str, email_to: str, body: dict, template: str
+) -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = conf.MAIL_FROM
+    message["To"] = email_to
+    message.set_content(renderer.render(template, body), subtype="html")
+    return message
@@ -0,0 +1,206 @@
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jose import JWTError, jwk
+
+from . import metrics
+from .config import Settings
+from .jwt_codecs import get_codec
+
+logger = logging.getLogger(__name__)
+
+JWT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+jwt_encode_latency = metrics.histogram(
+    "jwt_encode_seconds", "Time to sign an access token.", buckets=JWT_BUCKETS
+)
+jwt_decode_latency = metrics.histogram(
+    "jwt_decode_seconds", "Time to verify a token signature.", buckets=JWT_BUCKETS
+)
+
+
+def generate_private_key(algorithm: str) -> bytes:
+    if algorithm == "ES256":
+        key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+class KeyRing:
+    # Every <kid>.pem in JWT_KEYS_DIR verifies tokens and is published in the
+    # JWKS. A new key only starts signing JWT_KEY_ACTIVATION_SECONDS after it
+    # appears, so gateways have refreshed their cached JWKS by then; old keys
+    # stay until every token they signed has expired. The directory is
+    # re-read every JWT_KEYS_RELOAD_SECONDS by a background job, which must
+    # stay below the activation delay so every process knows a key before
+    # any process signs with it.
+    def __init__(
+        self,
+        algorithm: str = Settings.JWT_ALGORITHM,
+        keys_dir: str = Settings.JWT_KEYS_DIR,
+        active_kid: str = Settings.JWT_ACTIVE_KID,
+        codec: str = Settings.JWT_CODEC,
+    ):
+        self.algorithm = algorithm
+        self.codec = get_codec(codec)
+        self.keys_dir = keys_dir
+        self.active_kid = active_kid
+        # (kid, key) as one attribute, so a reload on another thread never
+        # pairs a new kid with the old key.
+        self.signer = (None, None)
+        self.verification_keys = {}
+        self.jwks = b'{"keys": []}'
+        self.jwks_etag = None
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def symmetric(self) -> bool:
+        return self.algorithm.startswith("HS")
+
+    def load(self):
+        if self.symmetric:
+            secret = Settings.JWT_SECRET_KEY
+            self.signer = (None, self.codec.signing_key(secret, self.algorithm))
+            self.verification_keys = {
+                None: self.codec.verification_key(secret, self.algorithm)
+            }
+        else:
+            self._load_asymmetric()
+        self.jwks_etag = '"{}"'.format(hashlib.sha256(self.jwks).hexdigest()[:32])
+        self.loaded_at = time.monotonic()
+
+    def _load_asymmetric(self):
+        # Per-process keys would make tokens from one worker fail on the
+        # others, so a shared key directory is required.
+        if not self.keys_dir:
+            raise RuntimeError(
+                "JWT_KEYS_DIR must be set to sign tokens with " + self.algorithm
+            )
+        paths = sorted_keys(self.keys_dir)
+        if not paths:
+            ensure_key(self.keys_dir, self.algorithm)
+            paths = sorted_keys(self.keys_dir)
+
+        pems = {}
+        signing_kid = None
+        activated_before = time.time() - Settings.JWT_KEY_ACTIVATION_SECONDS
+        for path in paths:
+            kid = os.path.basename(path)[: -len(".pem")]
+            with open(path, "rb") as file:
+                pems[kid] = file.read()
+            if signing_kid is None or os.path.getmtime(path) <= activated_before:
+                signing_kid = kid
+
+        if self.active_kid in pems:
+            signing_kid = self.active_kid
+        document = {
+            "keys": [
+                dict(
+                    jwk.construct(pem, self.algorithm).public_key().to_dict(),
+                    kid=kid,
+                    use="sig",
+                )
+                for kid, pem in pems.items()
+            ]
+        }
+        self.signer = (
+            signing_kid,
+            self.codec.signing_key(pems[signing_kid], self.algorithm),
+        )
+        self.verification_keys = {
+            kid: self.codec.verification_key(pem, self.algorithm)
+            for kid, pem in pems.items()
+        }
+        self.jwks = json.dumps(document, sort_keys=True).encode()
+
+    def ensure_loaded(self):
+        # The app loads at startup; this covers scripts and tests.
+        if self.loaded_at is None:
+            with self._lock:
+                if self.loaded_at is None:
+                    self.load()
+
+    def encode(self, claims: dict) -> str:
+        self.ensure_loaded()
+        kid, key = self.signer
+        headers = {"kid": kid} if kid else None
+        with metrics.timed(jwt_encode_latency, "jwt_encode"):
+            return self.codec.encode(claims, key, self.algorithm, headers)
+
+    def decode(self, token: str) -> dict:
+        self.ensure_loaded()
+        key = self.verification_keys.get(self.codec.header(token).get("kid"))
+        if key is None:
+            raise JWTError("Unknown signing key")
+        with metrics.timed(jwt_decode_latency, "jwt_decode"):
+            return self.codec.decode(token, key, self.algorithm)
+
+
+keyring = KeyRing()
+
+
+def sorted_keys(keys_dir: str):
+    return sorted(glob.glob(os.path.join(keys_dir, "*.pem")), key=os.path.getmtime)
+
+
+def write_key(keys_dir: str, algorithm: str) -> str:
+    os.makedirs(keys_dir, exist_ok=True)
+    path = os.path.join(keys_dir, "{}.pem".format(uuid.uuid4().hex[:16]))
+    # Written under a temporary name so readers never see a partial key.
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(generate_private_key(algorithm))
+    os.chmod(temporary, 0o600)
+    os.replace(temporary, path)
+    return path
+
+
+def ensure_key(keys_dir: str, algorithm: str):
+    # First start with an empty directory: workers racing here serialize on
+    # a lock file, so exactly one key is created and all of them use it.
+    os.makedirs(keys_dir, exist_ok=True)
+    with open(os.path.join(keys_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not sorted_keys(keys_dir):
+            logger.info("No keys in %s, creating one", keys_dir)
+            write_key(keys_dir, algorithm)
+
+
+def rotate(keys_dir: str, algorithm: str, retire_after: float):
+    # Adds a signing key and deletes keys whose successor took over signing
+    # long enough ago that every token they issued has expired.
+    path = write_key(keys_dir, algorithm)
+
+    paths = sorted_keys(keys_dir)
+    retired_before = time.time() - Settings.JWT_KEY_ACTIVATION_SECONDS - retire_after
+    for older, newer in zip(paths, paths[1:]):
+        if os.path.getmtime(newer) < retired_before:
+            os.remove(older)
+    return path
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rotate"] or not Settings.JWT_KEYS_DIR:
+        sys.exit("usage: JWT_KEYS_DIR=... python -m app.signing rotate")
+    print(
+        rotate(
+            Settings.JWT_KEYS_DIR,
+            Settings.JWT_ALGORITHM,
+            Settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60 + 60,
+        )
+    )
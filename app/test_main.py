@@ -1,16 +1,58 @@
+import asyncio
+import hashlib
+import io
 import json
+import os
+import socket
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
 
+import fakeredis
 import pytest
 import sqlalchemy as sa
+from aiosmtpd.controller import Controller
 from fastapi.testclient import TestClient
+from jinja2 import Environment, FileSystemLoader
+from jose import JWTError, jwt
+from PIL import Image
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from starlette.requests import Request
 
-from . import main
+from . import (
+    admission,
+    async_crud,
+    claims_cache,
+    crud,
+    database,
+    email_templates,
+    hashing,
+    mail_delivery,
+    main,
+    maintenance,
+    metrics,
+    outbox_worker,
+    profile_images,
+    query_profiler,
+    rate_limit,
+    revocation,
+    signing,
+    token_store,
+    upgrade_schema,
+    user_cache,
+)
 from .database import Base
+from .send_email import build_message
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
@@ -46,6 +88,29 @@ def client(session):
     del main.app.dependency_overrides[main.get_db]
 
 
+@pytest.fixture()
+def async_client():
+    async_engine = create_async_engine(
+        ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=NullPool
+    )
+    AsyncTestingSessionLocal = sessionmaker(
+        bind=async_engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_get_db():
+        async with AsyncTestingSessionLocal() as db:
+            yield db
+
+    main.app.dependency_overrides[main.get_db] = override_get_db
+    yield TestClient(main.app)
+    del main.app.dependency_overrides[main.get_db]
+
+
+@pytest.fixture()
+def strict_mode(monkeypatch):
+    monkeypatch.setattr(main.Settings, "TOKEN_MODE", "strict")
+
+
 HEADERS = {"accept": "application/json", "Content-Type": "application/json"}
 
 
@@ -154,3 +219,1246 @@ def test_update_password_correct(client):
         response["message"]
         == "Password is updated Successfully. Please login again with updated password"
     )
+
+
+def test_revoked_token_is_rejected(client, strict_mode):
+    response = client.get("/api/v1/me", headers=HEADERS)
+    assert response.status_code == 401
+
+
+def test_revocation_index_skips_database_for_unknown_tokens(session):
+    index = revocation.RevocationIndex(capacity=1000, error_rate=0.01)
+    asyncio.run(index.sync(session))
+    revoked = HEADERS["Authorization"].split(" ")[1]
+
+    assert asyncio.run(index.is_revoked(session, revoked))
+    assert not asyncio.run(index.is_revoked(session, str(uuid.uuid4())))
+    assert index.stats()["hit_rate"] > 0
+
+
+def test_revocation_index_syncs_in_the_background(session, monkeypatch):
+    index = revocation.RevocationIndex(capacity=1000, error_rate=0.01)
+    monkeypatch.setattr(revocation, "index", index)
+    asyncio.run(index.sync(session))
+    token = main.create_access_token(
+        data={"sub": EMAIL}, expires_delta=timedelta(minutes=5)
+    )
+    # Logged out on another worker: only the table has it.
+    asyncio.run(async_crud.run(crud.save_black_list_token, session, token, EMAIL))
+    assert not asyncio.run(index.is_revoked(session, token))
+
+    @asynccontextmanager
+    async def test_session_scope():
+        yield session
+
+    monkeypatch.setattr(maintenance, "session_scope", test_session_scope)
+    asyncio.run(maintenance.sync_revocation_index())
+    assert asyncio.run(index.is_revoked(session, token))
+
+
+def test_revocation_sync_catches_rows_committed_out_of_id_order(session):
+    index = revocation.RevocationIndex(capacity=1000, error_rate=0.01)
+    expires_at = datetime.utcnow() + timedelta(minutes=5)
+    base = session.query(sa.func.coalesce(sa.func.max(main.models.BlackLists.id), 0))
+    base = base.scalar()
+    late, early = uuid.uuid4().hex, uuid.uuid4().hex
+    asyncio.run(index.sync(session))
+    added = index.filter.count
+    # Another worker's logout took the lower id but committed second.
+    session.add(main.models.BlackLists(id=base + 5, jti=early, expires_at=expires_at))
+    session.commit()
+    asyncio.run(index.sync(session))
+    session.add(main.models.BlackLists(id=base + 2, jti=late, expires_at=expires_at))
+    session.commit()
+    asyncio.run(index.sync(session))
+    assert late in index.revoked and early in index.revoked
+    # Rows read again by the lookback are not added to the filter twice.
+    assert index.filter.count == added + 2
+
+
+@pytest.fixture()
+def redis_store():
+    store = token_store.RedisTokenStore(fakeredis.FakeStrictRedis())
+    token_store.set_store(store)
+    yield store
+    token_store.set_store(None)
+
+
+def test_redis_store_expires_with_token(session, redis_store):
+    token = main.create_access_token(
+        data={"sub": EMAIL}, expires_delta=timedelta(minutes=5)
+    )
+    asyncio.run(revocation.revoke(session, token, EMAIL))
+
+    assert asyncio.run(revocation.is_revoked(session, token))
+    assert not asyncio.run(revocation.is_revoked(session, str(uuid.uuid4())))
+    assert 0 < redis_store.client.ttl(redis_store.key(token)) <= 300
+
+
+def test_logout_with_redis_store(client, redis_store, strict_mode):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    response = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    )
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+
+    assert client.post("/api/v1/logout", headers=headers).status_code == 200
+    assert client.get("/api/v1/me", headers=headers).status_code == 401
+
+
+def test_profile_update_invalidates_cached_user(client):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    response = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    )
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+
+    me = client.get("/api/v1/me", headers=headers).json()
+    assert me["first_name"] is None and "hashed_password" not in me
+    assert user_cache.cache.get(email) is not None
+    assert "hashed_password" not in client.get("/api/v1/me", headers=headers).json()
+    client.put(
+        "/api/v1/profile_update",
+        headers=headers,
+        json={"email": email, "first_name": "updated"},
+    )
+    assert client.get("/api/v1/me", headers=headers).json()["first_name"] == "updated"
+
+
+def test_user_cache_is_bounded():
+    cache = user_cache.UserCache(ttl=60, max_size=2)
+    for user_id in range(3):
+        cache.put(main.models.User(id=user_id, email="{}@gmail.com".format(user_id)))
+
+    assert cache.get("0@gmail.com") is None
+    assert cache.get_by_id(2).email == "2@gmail.com"
+    cache.invalidate(user_id=2)
+    assert cache.get("2@gmail.com") is None
+
+
+def test_async_crud_mirrors_crud():
+    for name, func in vars(crud).items():
+        if name.startswith("_") or getattr(func, "__module__", None) != crud.__name__:
+            continue
+        assert asyncio.iscoroutinefunction(getattr(async_crud, name)), name
+
+
+def test_async_session_flow(async_client, strict_mode):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    response = async_client.post(
+        "/api/v1/register", json={"email": email, "password": password}
+    )
+    assert response.json()["email"] == email
+    response = async_client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    )
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+
+    assert async_client.get("/api/v1/me", headers=headers).json()["email"] == email
+    assert async_client.post("/api/v1/logout", headers=headers).status_code == 200
+    assert async_client.get("/api/v1/me", headers=headers).status_code == 401
+
+
+def test_async_crud_covers_every_async_function():
+    for name, func in vars(async_crud).items():
+        defined_here = getattr(func, "__module__", None) == async_crud.__name__
+        if defined_here and asyncio.iscoroutinefunction(func) and name != "run":
+            assert async_crud.ASYNC_VERSIONS[getattr(crud, name)] is func
+
+
+def test_sync_session_is_closed_off_the_event_loop(monkeypatch):
+    closed_on = []
+
+    class FakeSession:
+        def close(self):
+            closed_on.append(threading.get_ident())
+
+    monkeypatch.setattr(database, "AsyncSessionLocal", None)
+    monkeypatch.setattr(database, "SessionLocal", FakeSession)
+
+    async def use_session():
+        async with database.session_scope():
+            return threading.get_ident()
+
+    loop_thread = asyncio.run(use_session())
+    assert closed_on and closed_on[0] != loop_thread
+
+
+def test_metrics_reports_pool(client, monkeypatch):
+    assert client.get("/internal/metrics").status_code == 404
+    assert client.get("/metrics").status_code == 404
+    monkeypatch.setattr(main.Settings, "METRICS_TOKEN", "scrape")
+    body = client.get("/metrics", headers={"Authorization": "Bearer scrape"}).text
+    assert "# TYPE db_pool_connections gauge" in body
+    assert "# TYPE db_pool_checkout_wait_seconds histogram" in body
+
+
+def test_instrumented_pool_records_checkouts(tmp_path):
+    pool_engine = create_engine(
+        "sqlite:///" + str(tmp_path / "pool.db"),
+        poolclass=database.InstrumentedQueuePool,
+        pool_size=1,
+        max_overflow=1,
+    )
+    database.instrument_pool(pool_engine.pool)
+    waits = database.pool_checkout_wait.count
+    overflows = database.pool_overflow_events.value
+
+    with pool_engine.connect(), pool_engine.connect():
+        assert database.pool_status(pool_engine.pool)["checked_out"] == 2
+        assert database.pool_overflow_events.value == overflows + 1
+    assert database.pool_status(pool_engine.pool)["idle"] == 1
+    assert database.pool_checkout_wait.count == waits + 2
+
+
+def test_routing_session_reads_replicas_until_first_write(tmp_path):
+    engines = {}
+    for name in ("primary", "replica_a", "replica_b"):
+        engines[name] = create_engine("sqlite:///" + str(tmp_path / (name + ".db")))
+        Base.metadata.create_all(bind=engines[name])
+        with engines[name].begin() as connection:
+            connection.execute(
+                main.models.User.__table__.insert(),
+                {"email": "user@gmail.com", "first_name": name},
+            )
+    RoutingSessionLocal = sessionmaker(
+        class_=database.RoutingSession,
+        bind=engines["primary"],
+        replicas=[engines["replica_a"], engines["replica_b"]],
+    )
+
+    def source(db):
+        db.expunge_all()
+        return crud.get_user_by_email(db, "user@gmail.com").first_name
+
+    db = RoutingSessionLocal()
+    assert {source(db) for _ in range(4)} == {"replica_a", "replica_b"}
+
+    crud.create_reset_code(db, "user@gmail.com", str(uuid.uuid4()))
+    assert {source(db) for _ in range(4)} == {"primary"}
+    db.close()
+
+    # The code has not reached the replicas yet.
+    code = str(uuid.uuid4())
+    crud.create_reset_code(
+        sessionmaker(bind=engines["primary"])(), "user@gmail.com", code
+    )
+    db = RoutingSessionLocal()
+    assert crud.consume_reset_code(db, code) == "user@gmail.com"
+    db.close()
+
+
+def test_reset_code_is_consumed_once(client, session):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    reset_code = str(uuid.uuid4())
+    crud.create_reset_code(session, email, reset_code)
+    payload = {
+        "reset_password_token": reset_code,
+        "new_password": "new@123",
+        "confirm_password": "new@123",
+    }
+
+    assert client.post("/api/v1/reset_password", json=payload).status_code == 200
+    assert client.post("/api/v1/reset_password", json=payload).status_code == 404
+    response = client.post(
+        "/api/v1/login", data={"username": email, "password": "new@123"}
+    )
+    assert response.status_code == 200
+
+
+def test_stale_reset_codes_are_swept(session):
+    used, expired, live = (str(uuid.uuid4()) for _ in range(3))
+    for code in (used, expired, live):
+        crud.create_reset_code(session, EMAIL, code)
+    assert crud.consume_reset_code(session, used) == EMAIL
+    session.query(main.models.Codes).filter(
+        main.models.Codes.reset_code == expired
+    ).update({"expired_in": datetime.now() - timedelta(minutes=1)})
+    session.commit()
+
+    assert crud.consume_reset_code(session, expired) is None
+    assert crud.delete_stale_reset_codes(session) >= 2
+    remaining = {code.reset_code for code in session.query(main.models.Codes)}
+    assert live in remaining and not {used, expired} & remaining
+
+
+def test_blacklist_stores_jti_with_expiry(session):
+    token = main.create_access_token(
+        data={"sub": EMAIL}, expires_delta=timedelta(minutes=5)
+    )
+    asyncio.run(revocation.revoke(session, token, EMAIL))
+
+    row = crud.find_black_list_token(session, token)
+    assert row.jti == jwt.get_unverified_claims(token)["jti"]
+    assert (
+        datetime.utcnow() < row.expires_at <= datetime.utcnow() + timedelta(minutes=5)
+    )
+
+
+def test_upgrade_schema_migrates_token_blacklist(tmp_path):
+    legacy = create_engine("sqlite:///" + str(tmp_path / "legacy.db"))
+    token = main.create_access_token(
+        data={"sub": EMAIL}, expires_delta=timedelta(minutes=5)
+    )
+    with legacy.begin() as connection:
+        connection.execute(
+            sa.text(
+                "CREATE TABLE blacklists "
+                "(id INTEGER PRIMARY KEY, token VARCHAR UNIQUE, email VARCHAR)"
+            )
+        )
+        connection.execute(
+            sa.text(
+                "CREATE TABLE codes (id INTEGER PRIMARY KEY, email VARCHAR, "
+                "reset_code VARCHAR, active BOOLEAN, expired_in DATETIME)"
+            )
+        )
+        connection.execute(
+            sa.text("INSERT INTO blacklists (token, email) VALUES (:token, :email)"),
+            {"token": token, "email": EMAIL},
+        )
+    with pytest.raises(RuntimeError, match="blacklists.jti"):
+        upgrade_schema.check(legacy)
+
+    upgrade_schema.upgrade(legacy)
+
+    upgrade_schema.check(legacy)
+    db = sessionmaker(bind=legacy)()
+    try:
+        assert crud.find_black_list_token(db, token).email == EMAIL
+    finally:
+        db.close()
+    indexes = {index["name"] for index in sa.inspect(legacy).get_indexes("codes")}
+    assert "ix_codes_reset_code" in indexes
+
+
+def test_blacklist_lookup_uses_index_and_compaction_purges(session, monkeypatch):
+    table = main.models.BlackLists.__table__
+    expired = datetime.utcnow() - timedelta(minutes=1)
+    session.execute(
+        table.insert(),
+        [{"jti": uuid.uuid4().hex, "expires_at": expired} for _ in range(2500)],
+    )
+    session.commit()
+
+    query = session.query(main.models.BlackLists).filter(
+        main.models.BlackLists.jti == "jti"
+    )
+    sql = str(
+        query.statement.compile(
+            dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+        )
+    )
+    plan = " ".join(
+        str(row[-1]) for row in session.execute(sa.text("EXPLAIN QUERY PLAN " + sql))
+    )
+    assert "USING INDEX" in plan or "USING COVERING INDEX" in plan
+
+    @asynccontextmanager
+    async def test_session_scope():
+        yield session
+
+    monkeypatch.setattr(maintenance, "session_scope", test_session_scope)
+    assert asyncio.run(maintenance.compact_blacklist(batch_size=1000)) >= 2500
+    assert (
+        session.query(main.models.BlackLists)
+        .filter(main.models.BlackLists.expires_at < datetime.utcnow())
+        .count()
+        == 0
+    )
+
+
+class RecordingSMTPHandler:
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        self.messages.append(envelope)
+        return "250 OK"
+
+
+@pytest.fixture()
+def smtp_server():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    handler = RecordingSMTPHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    yield handler, port
+    controller.stop()
+
+
+def reset_message(email):
+    return build_message(
+        "Password Reset",
+        email,
+        {"protocol": "http", "domain": "localhost", "url": "/reset"},
+        "password_reset_email.html",
+    )
+
+
+def test_smtp_pool_reuses_connections(smtp_server):
+    handler, port = smtp_server
+    messages = [reset_message("{}@gmail.com".format(n)) for n in range(30)]
+
+    async def run():
+        pool = mail_delivery.SMTPConnectionPool("127.0.0.1", port, size=2)
+
+        async def send(message):
+            smtp = await pool.acquire()
+            try:
+                await smtp.send_message(message)
+            finally:
+                await pool.release(smtp)
+
+        try:
+            await asyncio.gather(*(send(message) for message in messages))
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+    assert len(handler.messages) == 30
+    assert len(handler.sessions) <= 2
+
+
+def test_forgot_password_writes_outbox_row(client, session):
+    response = client.post("/api/v1/forgot_password", json={"email": EMAIL})
+
+    assert response.status_code == 200
+    row = (
+        session.query(main.models.EmailOutbox)
+        .order_by(main.models.EmailOutbox.id.desc())
+        .first()
+    )
+    assert row.recipient == EMAIL and row.sent_at is None
+    code = session.query(main.models.Codes).order_by(main.models.Codes.id.desc())
+    assert code.first().reset_code in row.body["url"]
+
+
+def test_outbox_worker_sends_and_retries(session, smtp_server):
+    handler, port = smtp_server
+    session.query(main.models.EmailOutbox).delete()
+    for recipient in ("a@gmail.com", "b@gmail.com"):
+        session.add(
+            main.models.EmailOutbox(
+                recipient=recipient,
+                subject="Password Reset",
+                template="password_reset_email.html",
+                body={"protocol": "http", "domain": "localhost", "url": "/reset"},
+            )
+        )
+    session.commit()
+
+    async def run(pool_port):
+        pool = mail_delivery.SMTPConnectionPool("127.0.0.1", pool_port, size=2)
+        try:
+            return await outbox_worker.process_batch(session, pool)
+        finally:
+            await pool.close()
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        closed_port = probe.getsockname()[1]
+    assert asyncio.run(run(closed_port)) == 2
+    rows = session.query(main.models.EmailOutbox).all()
+    assert all(row.attempts == 1 and row.sent_at is None for row in rows)
+
+    session.query(main.models.EmailOutbox).update(
+        {"next_attempt_at": datetime.utcnow()}
+    )
+    session.commit()
+    assert asyncio.run(run(port)) == 2
+    assert len(handler.messages) == 2
+    assert asyncio.run(run(port)) == 0
+
+
+def test_outbox_row_errors_do_not_resend_the_batch(session, smtp_server, monkeypatch):
+    handler, port = smtp_server
+    monkeypatch.setattr(main.Settings, "OUTBOX_MAX_ATTEMPTS", 1)
+    session.query(main.models.EmailOutbox).delete()
+    for template in ("password_reset_email.html", "missing.html"):
+        session.add(
+            main.models.EmailOutbox(
+                recipient=EMAIL,
+                subject="Password Reset",
+                template=template,
+                body={"protocol": "http", "domain": "localhost", "url": "/reset"},
+            )
+        )
+    session.commit()
+    undeliverable = outbox_worker.outbox_undeliverable.value
+
+    async def run():
+        pool = mail_delivery.SMTPConnectionPool("127.0.0.1", port, size=1)
+        try:
+            claimed = await outbox_worker.process_batch(session, pool)
+            # The one slot is free again, so this does not wait.
+            await asyncio.wait_for(pool.release(await pool.acquire()), 1)
+            return claimed
+        finally:
+            await pool.close()
+
+    assert asyncio.run(run()) == 2
+    assert len(handler.messages) == 1
+    failed = session.query(main.models.EmailOutbox).filter_by(template="missing.html")
+    assert failed.one().attempts == 1
+    assert outbox_worker.outbox_undeliverable.value == undeliverable + 1
+    assert asyncio.run(outbox_worker.process_batch(session, None)) == 0
+
+    @asynccontextmanager
+    async def test_session_scope():
+        yield session
+
+    monkeypatch.setattr(maintenance, "session_scope", test_session_scope)
+    monkeypatch.setattr(main.Settings, "OUTBOX_RETENTION_DAYS", -1)
+    assert asyncio.run(maintenance.purge_outbox()) == 2
+    assert maintenance.outbox_undeliverable_rows.value == 0
+
+
+def login_headers(client):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    response = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    )
+    return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+
+def test_profile_image_upload_streams_to_content_addressed_file(
+    client, session, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(main.Settings, "IMAGE_POOL_WORKERS", 0)
+    monkeypatch.setattr(main.Settings, "UPLOAD_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_MAX_BYTES", 10000)
+    content = os.urandom(5000)
+    digest = hashlib.sha256(content).hexdigest()
+    users = session.query(main.models.User).count()
+
+    paths = []
+    for _ in range(2):
+        headers = login_headers(client)
+        response = client.post(
+            "/api/v1/upload_profile_image",
+            headers=headers,
+            files={"file": ("avatar.png", content, "image/png")},
+        )
+        assert response.status_code == 200
+        paths.append(response.json()["profile_image"])
+        me = client.get("/api/v1/me", headers=headers).json()
+        assert me["user_profile_image"] == paths[-1]
+
+    assert paths[0] == paths[1] == os.path.join("objects", digest[:2], digest)
+    assert (tmp_path / paths[0]).read_bytes() == content
+    assert session.query(main.models.User).count() == users + 2
+
+    response = client.post(
+        "/api/v1/upload_profile_image",
+        headers=headers,
+        files={"file": ("big.png", os.urandom(10001), "image/png")},
+    )
+    assert response.status_code == 413
+    assert list((tmp_path / "tmp").iterdir()) == []
+
+
+def test_oversized_upload_is_rejected_before_the_form_is_parsed(client, monkeypatch):
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_MAX_BYTES", 10000)
+    monkeypatch.setattr(
+        profile_images, "store_upload", lambda file: pytest.fail("form parsed")
+    )
+    headers = login_headers(client)
+    content = os.urandom(10000 + profile_images.MULTIPART_OVERHEAD)
+    response = client.post(
+        "/api/v1/upload_profile_image",
+        headers=headers,
+        files={"file": ("big.png", content, "image/png")},
+    )
+    assert response.status_code == 413
+
+    def chunks():
+        yield (
+            b"--x\r\nContent-Disposition: form-data; name=file; filename=big.png"
+            b"\r\nContent-Type: image/png\r\n\r\n"
+        )
+        for start in range(0, len(content), 4096):
+            yield content[start : start + 4096]
+        yield b"\r\n--x--\r\n"
+
+    response = client.post(
+        "/api/v1/upload_profile_image",
+        headers=dict(headers, **{"Content-Type": "multipart/form-data; boundary=x"}),
+        data=chunks(),
+    )
+    assert response.status_code == 413
+    assert "larger than 10000 bytes" in response.json()["detail"]
+
+
+def test_profile_image_serving_supports_etag_and_range(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(main.Settings, "IMAGE_POOL_WORKERS", 0)
+    content = b"\x89PNG\r\n\x1a\n" + os.urandom(200000)
+    headers = login_headers(client)
+    client.post(
+        "/api/v1/upload_profile_image",
+        headers=headers,
+        files={"file": ("avatar.png", content, "image/png")},
+    )
+    user_id = client.get("/api/v1/me", headers=headers).json()["id"]
+    url = "/api/v1/users/{}/profile_image".format(user_id)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["etag"] == '"{}"'.format(
+        hashlib.sha256(content).hexdigest()
+    )
+    assert "max-age" in response.headers["cache-control"]
+
+    etag = response.headers["etag"]
+    for if_none_match in (etag, "W/" + etag, '"other", W/' + etag, "*"):
+        response = client.get(url, headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+    monkeypatch.setattr(profile_images, "SEND_CHUNK_SIZE", 65536)
+    assert client.get(url).content == content
+    response = client.get(url, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.content == content[100:200]
+    assert response.headers["content-range"] == "bytes 100-199/{}".format(len(content))
+    assert client.get(url, headers={"Range": "bytes=-10"}).content == content[-10:]
+    response = client.get(url, headers={"Range": "bytes=999999-"})
+    assert response.status_code == 416
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert client.get("/api/v1/users/0/profile_image").status_code == 404
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    image = profile_images.absolute_path(
+        client.get("/api/v1/me", headers=headers).json()["user_profile_image"]
+    )
+    response = profile_images.FileRangeResponse(image, 10, 19, 206, {}, "image/png")
+    scope = {"extensions": {"http.response.zerocopy": {}}}
+    asyncio.run(response(scope, None, send))
+    assert messages[1]["type"] == "http.response.zerocopy"
+    assert (messages[1]["offset"], messages[1]["count"]) == (10, 10)
+
+
+def test_profile_image_variants_fall_back_to_original(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(main.Settings, "IMAGE_POOL_WORKERS", 0)
+    monkeypatch.setattr(main.image_variants, "schedule", lambda path: None)
+    buffer = io.BytesIO()
+    Image.new("RGB", (600, 300), "red").save(buffer, format="PNG")
+    headers = login_headers(client)
+    client.post(
+        "/api/v1/upload_profile_image",
+        headers=headers,
+        files={"file": ("avatar.png", buffer.getvalue(), "image/png")},
+    )
+    me = client.get("/api/v1/me", headers=headers).json()
+    url = "/api/v1/users/{}/profile_image".format(me["id"])
+
+    response = client.get(url, params={"size": 100})
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["cache-control"] == "public, max-age=0"
+
+    asyncio.run(main.image_variants.generate(me["user_profile_image"]))
+    response = client.get(url, params={"size": 100})
+    assert response.headers["content-type"] == "image/webp"
+    assert Image.open(io.BytesIO(response.content)).size == (128, 64)
+    assert client.get(url, params={"size": 1000}).content == buffer.getvalue()
+    assert client.get(url).headers["content-type"] == "image/png"
+
+
+def test_missing_variants_are_regenerated_on_the_process_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(main.Settings, "IMAGE_POOL_WORKERS", 1)
+    monkeypatch.setattr(main.image_variants, "_known", OrderedDict())
+    source = profile_images.blob_path(uuid.uuid4().hex)
+    os.makedirs(os.path.dirname(profile_images.absolute_path(source)))
+    Image.new("RGB", (600, 300), "red").save(
+        profile_images.absolute_path(source), format="PNG"
+    )
+    variant = main.image_variants.variant_path(source, 128)
+
+    async def request_variant():
+        picked = await main.image_variants.pick(source, 100)
+        if source in main.image_variants._pending:
+            await main.image_variants._pending[source]
+        return picked
+
+    try:
+        for _ in range(2):
+            # Nothing on disk yet, then the variants lost as after a restart.
+            assert asyncio.run(request_variant()) == (source, False)
+            assert asyncio.run(request_variant()) == (variant, True)
+            with Image.open(profile_images.absolute_path(variant)) as image:
+                assert image.size == (128, 64)
+            directory = os.path.dirname(profile_images.absolute_path(variant))
+            assert not [name for name in os.listdir(directory) if ".tmp" in name]
+            os.remove(profile_images.absolute_path(variant))
+            main.image_variants._known.clear()
+    finally:
+        main.image_variants.shutdown_executor()
+
+
+def test_failed_variants_are_retried_later(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(main.Settings, "IMAGE_POOL_WORKERS", 0)
+    monkeypatch.setattr(main.image_variants, "_failed", OrderedDict())
+    monkeypatch.setattr(main.image_variants, "FAILED_SOURCES_MAX", 1)
+    broken, other = (profile_images.blob_path(uuid.uuid4().hex) for _ in range(2))
+    for source in (broken, other):
+        os.makedirs(os.path.dirname(profile_images.absolute_path(source)))
+        with open(profile_images.absolute_path(source), "wb") as file:
+            file.write(b"not an image")
+
+    asyncio.run(main.image_variants.generate(broken))
+    assert asyncio.run(main.image_variants.pick(broken, 100)) == (broken, True)
+    monkeypatch.setattr(main.image_variants, "FAILED_RETRY_SECONDS", 0)
+    assert not main.image_variants.has_failed(broken)
+
+    asyncio.run(main.image_variants.generate(broken))
+    asyncio.run(main.image_variants.generate(other))
+    assert list(main.image_variants._failed) == [other]
+
+
+def test_access_tokens_verify_against_published_jwks(client):
+    headers = login_headers(client)
+    token = headers["Authorization"].split()[1]
+    response = client.get("/.well-known/jwks.json")
+    assert response.status_code == 200
+    assert "max-age" in response.headers["cache-control"]
+
+    keys = {key["kid"]: key for key in response.json()["keys"]}
+    kid = jwt.get_unverified_header(token)["kid"]
+    claims = jwt.decode(token, keys[kid], algorithms=["RS256"])
+    assert claims["jti"]
+    etag = response.headers["etag"]
+    response = client.get("/.well-known/jwks.json", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_key_rotation_keeps_old_tokens_valid(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.Settings, "JWT_KEY_ACTIVATION_SECONDS", 60)
+    keyring = signing.KeyRing("ES256", str(tmp_path), "")
+    monkeypatch.setattr(signing, "keyring", keyring)
+    cache = claims_cache.ClaimsCache()
+    first = signing.rotate(str(tmp_path), "ES256", retire_after=3600)
+    os.utime(first, (time.time() - 10, time.time() - 10))
+    old_token = keyring.encode({"sub": EMAIL, "exp": time.time() + 3600})
+
+    signing.rotate(str(tmp_path), "ES256", retire_after=3600)
+    keyring.load()
+    assert len(json.loads(keyring.jwks)["keys"]) == 2
+    # Published but not signing until gateways had time to fetch it.
+    assert jwt.get_unverified_header(keyring.encode({}))["kid"] in first
+
+    os.utime(first, (0, 0))
+    monkeypatch.setattr(main.Settings, "JWT_KEY_ACTIVATION_SECONDS", 0)
+    keyring.load()
+    assert jwt.get_unverified_header(keyring.encode({}))["kid"] not in first
+    assert keyring.decode(old_token)["sub"] == EMAIL
+    assert cache.decode(old_token) == cache.decode(old_token)
+
+    signing.rotate(str(tmp_path), "ES256", retire_after=-60)
+    assert not os.path.exists(first)
+    with pytest.raises(JWTError):
+        signing.KeyRing("HS256").decode(old_token)
+    # Cached claims of a retired key go once the keyring reloads.
+    keyring.load()
+    assert cache.get(old_token) is None
+    with pytest.raises(JWTError):
+        cache.decode(old_token)
+
+
+def test_asymmetric_keys_are_shared_not_ephemeral(tmp_path):
+    with pytest.raises(RuntimeError):
+        signing.KeyRing("RS256", "", "").load()
+
+    keys_dir = str(tmp_path / "keys")
+    first, second = (signing.KeyRing("RS256", keys_dir, "") for _ in range(2))
+    token = first.encode({"sub": EMAIL})
+    assert second.decode(token)["sub"] == EMAIL
+    assert len(signing.sorted_keys(keys_dir)) == 1
+
+
+@pytest.fixture()
+def gateway(monkeypatch):
+    monkeypatch.setattr(main.Settings, "INTROSPECTION_CLIENTS", {"gateway": "s3cret"})
+    return ("gateway", "s3cret")
+
+
+def test_introspection_requires_client_credentials(client, gateway):
+    body = {"tokens": [login_headers(client)["Authorization"].split()[1]]}
+    assert client.post("/api/v1/introspect", json=body).status_code == 401
+    response = client.post("/api/v1/introspect", json=body, auth=("gateway", "wrong"))
+    assert response.status_code == 401
+    response = client.post("/api/v1/introspect", json=body, auth=gateway)
+    assert response.json()["results"][0]["active"]
+
+
+def test_introspection_batches_lookups(client, monkeypatch, gateway):
+    tokens = [login_headers(client)["Authorization"].split()[1] for _ in range(3)]
+    client.post("/api/v1/logout", headers={"Authorization": "Bearer " + tokens[2]})
+    user_cache.cache.clear()
+    # A saturated filter sends every unknown token to the database.
+    saturated = revocation.BloomFilter(10, 0.5)
+    saturated.bits = bytearray(b"\xff" * len(saturated.bits))
+    monkeypatch.setattr(revocation.index, "filter", saturated)
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sa.event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.post(
+            "/api/v1/introspect",
+            json={"tokens": [tokens[0], "garbage", tokens[1], tokens[0], tokens[2]]},
+            auth=gateway,
+        )
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", record)
+
+    results = response.json()["results"]
+    assert [result["active"] for result in results] == [
+        True,
+        False,
+        True,
+        True,
+        False,
+    ]
+    assert results[0] == results[3] and results[0]["user_id"] != results[2]["user_id"]
+    assert results[0]["claims"]["jti"] == jwt.get_unverified_claims(tokens[0])["jti"]
+    assert len([sql for sql in statements if "FROM users" in sql]) == 1
+    assert len([sql for sql in statements if "blacklists.jti IN" in sql]) == 1
+    assert not [sql for sql in statements if "blacklists.jti =" in sql]
+
+    response = client.post(
+        "/api/v1/introspect", json={"tokens": ["x"] * 501}, auth=gateway
+    )
+    assert response.status_code == 413
+
+
+def test_refresh_tokens_rotate_and_detect_reuse(client):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    tokens = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    ).json()
+    claims = jwt.get_unverified_claims(tokens["access_token"])
+    assert (
+        claims["exp"] - time.time() <= main.Settings.REFRESH_ACCESS_TOKEN_MINUTES * 60
+    )
+
+    refreshed = client.post(
+        "/api/v1/refresh", json={"refresh_token": tokens["refresh_token"]}
+    ).json()
+    assert refreshed["user_id"] == tokens["user_id"]
+    assert refreshed["refresh_token"] != tokens["refresh_token"]
+    headers = {"Authorization": "Bearer " + refreshed["access_token"]}
+    assert client.get("/api/v1/me", headers=headers).json()["email"] == email
+
+    # Replaying the used token revokes the whole family, including its successor.
+    for refresh_token in (tokens["refresh_token"], refreshed["refresh_token"]):
+        response = client.post("/api/v1/refresh", json={"refresh_token": refresh_token})
+        assert response.status_code == 401
+
+    tokens = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    ).json()
+    headers = {"Authorization": "Bearer " + tokens["access_token"]}
+    assert client.post("/api/v1/logout", headers=headers).status_code == 200
+    response = client.post(
+        "/api/v1/refresh", json={"refresh_token": tokens["refresh_token"]}
+    )
+    assert response.status_code == 401
+
+
+def test_strict_mode_issues_no_refresh_tokens(client, strict_mode):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    tokens = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    ).json()
+    assert tokens["refresh_token"] is None
+    claims = jwt.get_unverified_claims(tokens["access_token"])
+    assert claims["exp"] - time.time() > main.ACCESS_TOKEN_EXPIRE_MINUTES * 60 - 60
+
+
+def test_claims_cache_serves_repeat_tokens_until_revoked(client, strict_mode):
+    headers = login_headers(client)
+    token = headers["Authorization"].split()[1]
+    cache = claims_cache.ClaimsCache(max_size=2)
+    hits = claims_cache.claims_cache_hits.value
+
+    assert cache.decode(token) == cache.decode(token)
+    assert claims_cache.claims_cache_hits.value == hits + 1
+    for number in range(2):
+        cache.put(str(number), {"exp": time.time() + 60})
+    assert cache.get(token) is None
+    cache.put("expired", {"exp": time.time() - 1})
+    assert cache.get("expired") is None
+
+    assert client.get("/api/v1/me", headers=headers).status_code == 200
+    assert claims_cache.cache.get(token) is not None
+    client.post("/api/v1/logout", headers=headers)
+    assert claims_cache.cache.get(token) is None
+    assert client.get("/api/v1/me", headers=headers).status_code == 401
+
+
+@pytest.mark.parametrize("algorithm", ["HS256", "RS256"])
+def test_jwt_codecs_interoperate(algorithm, tmp_path):
+    signing.rotate(str(tmp_path), algorithm, retire_after=3600)
+    names = ["jose", "pyjwt"] + (["builtin"] if algorithm == "HS256" else [])
+    keyrings = [signing.KeyRing(algorithm, str(tmp_path), "", name) for name in names]
+    claims = {"sub": EMAIL, "exp": datetime.utcnow() + timedelta(minutes=1)}
+
+    for issuer in keyrings:
+        token = issuer.encode(claims)
+        for verifier in keyrings:
+            assert verifier.decode(token)["sub"] == EMAIL
+        with pytest.raises(JWTError):
+            keyrings[-1].decode(token[:-4] + "AAAA")
+
+    expired = dict(claims, exp=datetime.utcnow() - timedelta(minutes=1))
+    for keyring in keyrings:
+        with pytest.raises(JWTError):
+            keyring.decode(keyring.encode(expired))
+    with pytest.raises(ValueError):
+        signing.KeyRing("RS256", str(tmp_path), "", "builtin").load()
+
+
+def test_templates_are_precompiled_and_render_in_batches(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bodies = [
+        {"protocol": "http", "domain": "localhost", "url": "/reset/" + str(number)}
+        for number in range(3)
+    ]
+    template = "password_reset_email.html"
+    assert template in email_templates.renderer.templates
+
+    environment = Environment(loader=FileSystemLoader(email_templates.TEMPLATE_FOLDER))
+    expected = [environment.get_template(template).render(body=body) for body in bodies]
+    assert email_templates.renderer.render_batch(template, bodies) == expected
+
+
+def test_hashing_pool_roundtrip():
+    hashed = asyncio.run(hashing.hash_password(PASSWORD))
+    assert asyncio.run(hashing.verify_password(PASSWORD, hashed))
+    assert not asyncio.run(hashing.verify_password(str(uuid.uuid4()), hashed))
+
+    snapshot = metrics.snapshot()
+    assert snapshot["hash_queue_depth"] == 0
+    assert snapshot["hash_latency_seconds"]["count"] >= 3
+
+
+@pytest.fixture(params=["memory", "redis"])
+def login_throttle(request, monkeypatch):
+    if request.param == "redis":
+        store = rate_limit.RedisWindowStore(fakeredis.FakeStrictRedis())
+    else:
+        store = rate_limit.MemoryWindowStore()
+    throttle = rate_limit.LoginThrottle(store)
+    rate_limit.set_throttle(throttle)
+    monkeypatch.setattr(rate_limit.Settings, "LOGIN_FAILURE_LIMIT", 2)
+    monkeypatch.setattr(rate_limit.Settings, "LOGIN_LOCKOUT_BASE_SECONDS", 30)
+    yield throttle
+    rate_limit.set_throttle(None)
+
+
+def test_login_lockout_skips_password_check(client, login_throttle, monkeypatch):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    verified = []
+    verify_password = hashing.verify_password
+
+    async def counting_verify_password(plain_password, hashed_password):
+        verified.append(hashed_password)
+        return await verify_password(plain_password, hashed_password)
+
+    monkeypatch.setattr(hashing, "verify_password", counting_verify_password)
+
+    wrong = {"username": email, "password": "wrong"}
+    assert client.post("/api/v1/login", data=wrong).status_code == 401
+    assert client.post("/api/v1/login", data=wrong).status_code == 401
+    response = client.post(
+        "/api/v1/login", data={"username": email.upper(), "password": password}
+    )
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 30
+    assert len(verified) == 2
+
+    # A third failure doubles the lockout.
+    login_throttle.store.acquire("email:" + email, 900, limit=3)
+    retry_after = asyncio.run(login_throttle.admit(email, "10.0.0.1"))
+    assert 30 < retry_after <= 60
+
+    other = {"username": str(uuid.uuid4()), "password": "wrong"}
+    assert client.post("/api/v1/login", data=other).status_code == 401
+
+
+def test_login_ip_limit_and_success_reset(client, login_throttle, monkeypatch):
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    wrong = {"username": email, "password": "wrong"}
+    right = {"username": email, "password": password}
+
+    assert client.post("/api/v1/login", data=wrong).status_code == 401
+    assert client.post("/api/v1/login", data=right).status_code == 200
+    assert client.post("/api/v1/login", data=wrong).status_code == 401
+    assert client.post("/api/v1/login", data=right).status_code == 200
+
+    monkeypatch.setattr(rate_limit.Settings, "LOGIN_IP_LIMIT", 4)
+    response = client.post("/api/v1/login", data=right)
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 60
+    assert asyncio.run(login_throttle.admit(email, "10.0.0.2")) == 0
+
+
+def test_login_attempts_count_before_hashing(login_throttle, monkeypatch):
+    email = str(uuid.uuid4()) + "@gmail.com"
+    # Two guesses still being hashed hold the email's two attempts.
+    assert asyncio.run(login_throttle.admit(email, "10.0.0.1")) == 0
+    assert asyncio.run(login_throttle.admit(email, "10.0.0.2")) == 0
+    assert asyncio.run(login_throttle.admit(email, "10.0.0.3")) > 0
+    asyncio.run(login_throttle.succeeded(email))
+    assert asyncio.run(login_throttle.admit(email, "10.0.0.3")) == 0
+
+
+def test_parallel_login_attempts_are_admitted_up_to_the_limit(login_throttle):
+    key = "email:" + str(uuid.uuid4())
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        waits = list(
+            pool.map(lambda _: login_throttle.store.acquire(key, 60, 3), range(16))
+        )
+    assert sum(wait == 0 for wait in waits) == 3
+
+
+def test_client_ip_behind_trusted_proxy(monkeypatch):
+    def request(peer, forwarded=None):
+        headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+        return Request({"type": "http", "client": (peer, 1234), "headers": headers})
+
+    spoofed = "1.2.3.4, 203.0.113.7"
+    assert rate_limit.client_ip(request("203.0.113.9", spoofed)) == "203.0.113.9"
+    monkeypatch.setattr(rate_limit.Settings, "TRUSTED_PROXIES", ["10.0.0.0/8"])
+    assert rate_limit.client_ip(request("10.0.0.5", spoofed)) == "203.0.113.7"
+    assert rate_limit.client_ip(request("10.0.0.5", "203.0.113.7, 10.1.1.1")) == (
+        "203.0.113.7"
+    )
+    assert rate_limit.client_ip(request("10.0.0.5")) == "10.0.0.5"
+    assert rate_limit.client_ip(request("203.0.113.9", spoofed)) == "203.0.113.9"
+
+
+def test_bulkhead_queues_then_sheds():
+    async def scenario():
+        bulkhead = admission.Bulkhead("test", limit=1, queue_size=1, timeout=0.2)
+        assert await bulkhead.acquire()
+        queued = asyncio.ensure_future(bulkhead.acquire())
+        await asyncio.sleep(0)
+        assert bulkhead.queue_depth.value == 1
+        assert not await bulkhead.acquire()
+
+        bulkhead.release()
+        assert await queued
+        assert bulkhead.active == 1 and bulkhead.queue_depth.value == 0
+
+        assert not await bulkhead.acquire()  # waits out the timeout
+        bulkhead.release()
+        assert bulkhead.active == 0
+        return bulkhead.shed.value
+
+    assert asyncio.run(scenario()) >= 2
+
+
+def test_full_route_class_returns_503(client, monkeypatch):
+    headers = login_headers(client)
+    monkeypatch.setitem(
+        admission.bulkheads, "hashing", admission.Bulkhead("closed", 0, 0, 0.1)
+    )
+    response = client.post(
+        "/api/v1/login", data={"username": EMAIL, "password": PASSWORD}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/api/v1/me", headers=headers).status_code == 200
+
+
+def test_metrics_endpoint_and_server_timing(client, monkeypatch):
+    assert "Server-Timing" not in client.get("/api/v1/me").headers
+    monkeypatch.setattr(main.Settings, "SERVER_TIMING", True)
+    monkeypatch.setattr(main.Settings, "METRICS_TOKEN", "scrape")
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    client.post("/api/v1/register", json={"email": email, "password": password})
+    response = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    )
+    timing = response.headers["Server-Timing"]
+    assert "bcrypt;dur=" in timing and "jwt_encode;dur=" in timing
+    assert timing.split(", ")[-1].startswith("total;dur=")
+
+    user_cache.cache.clear()
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+    timing = client.get("/api/v1/me", headers=headers).headers["Server-Timing"]
+    assert "jwt_decode;dur=" in timing and "db_user;dur=" in timing
+    client.get("/api/v1/users/12345/profile_image")
+
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape"})
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert "# TYPE http_request_duration_seconds histogram" in body
+    assert (
+        'http_requests_total{method="POST",route="/api/v1/login",status="200"}' in body
+    )
+    assert (
+        'http_requests_total{method="GET",route="/api/v1/users/{user_id}/profile_image"'
+        in body
+    )
+    assert 'hash_latency_seconds_bucket{le="+Inf"}' in body
+    assert "jwt_decode_seconds_count" in body
+
+
+@pytest.fixture()
+def assert_queries():
+    # Pins the number of SQL statements an endpoint runs, so an extra lookup
+    # or refresh() round trip fails here instead of in production.
+    @contextmanager
+    def assert_queries(expected: int):
+        with query_profiler.profile() as stats:
+            yield stats
+        assert stats.count == expected, "\n".join(stats.statements)
+
+    return assert_queries
+
+
+def test_endpoint_query_counts(
+    client, session, assert_queries, gateway, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(main.Settings, "PROFILE_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(main.image_variants, "schedule", lambda path: None)
+    user_cache.cache.clear()
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    with assert_queries(3):
+        client.post("/api/v1/register", json={"email": email, "password": password})
+    with assert_queries(2):
+        client.post("/token", data={"username": email, "password": password})
+    with assert_queries(2):
+        tokens = client.post(
+            "/api/v1/login", data={"username": email, "password": password}
+        ).json()
+    headers = {"Authorization": "Bearer " + tokens["access_token"]}
+    with assert_queries(1):
+        client.get("/api/v1/me", headers=headers)
+    with assert_queries(0):
+        client.get("/api/v1/me", headers=headers)
+    with assert_queries(2):
+        response = client.put(
+            "/api/v1/profile_update",
+            json={"email": email, "first_name": "Query"},
+            headers=headers,
+        )
+    assert response.status_code == 200
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), "red").save(buffer, format="PNG")
+    # The profile update dropped the cached user, so this reloads it.
+    with assert_queries(2):
+        response = client.post(
+            "/api/v1/upload_profile_image",
+            headers=headers,
+            files={"file": ("avatar.png", buffer.getvalue(), "image/png")},
+        )
+    assert response.status_code == 200
+    url = "/api/v1/users/{}/profile_image".format(tokens["user_id"])
+    with assert_queries(1):
+        assert client.get(url).status_code == 200
+    with assert_queries(5):
+        tokens = client.post(
+            "/api/v1/refresh", json={"refresh_token": tokens["refresh_token"]}
+        ).json()
+    # After rotation, and with the user cached again.
+    with assert_queries(4):
+        tokens = client.post(
+            "/api/v1/refresh", json={"refresh_token": tokens["refresh_token"]}
+        ).json()
+    headers = {"Authorization": "Bearer " + tokens["access_token"]}
+    with assert_queries(0):
+        client.post(
+            "/api/v1/introspect",
+            json={"tokens": [tokens["access_token"]]},
+            auth=gateway,
+        )
+    with assert_queries(4):
+        client.post("/api/v1/forgot_password", json={"email": email})
+    with assert_queries(4):
+        password = str(uuid.uuid4())
+        response = client.put(
+            "/api/v1/update_password",
+            json={"password": password, "re_password": password},
+            headers=headers,
+        )
+    assert response.status_code == 200
+
+    reset_code, password = str(uuid.uuid4()), str(uuid.uuid4())
+    crud.create_reset_code(session, email, reset_code)
+    with assert_queries(6):
+        response = client.post(
+            "/api/v1/reset_password",
+            json={
+                "reset_password_token": reset_code,
+                "new_password": password,
+                "confirm_password": password,
+            },
+        )
+    assert response.status_code == 200
+    tokens = client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    ).json()
+    headers = {"Authorization": "Bearer " + tokens["access_token"]}
+    with assert_queries(4):
+        assert client.post("/api/v1/logout", headers=headers).status_code == 200
+    with assert_queries(1):
+        assert client.delete("/api/v1/forget_me", headers=headers).status_code == 200
+
+
+def test_request_over_query_budget_is_logged(client, monkeypatch, caplog):
+    monkeypatch.setattr(query_profiler.Settings, "SQL_QUERY_BUDGET", 1)
+    email, password = str(uuid.uuid4()) + "@gmail.com", str(uuid.uuid4())
+    with caplog.at_level("WARNING", logger="app.query_profiler"):
+        client.post("/api/v1/register", json={"email": email, "password": password})
+    assert "POST /api/v1/register ran 3 queries and 1 commits" in caplog.text
+
+
+def test_failed_statement_does_not_leak_its_start_time(session):
+    connection = session.connection()
+    with pytest.raises(sa.exc.OperationalError):
+        connection.execute(sa.text("SELECT * FROM no_such_table"))
+    assert not connection.info.get("query_start")
+
+
+def test_logout_after_password_change_with_same_token(client):
+    headers = login_headers(client)
+    password = str(uuid.uuid4())
+    response = client.put(
+        "/api/v1/update_password",
+        json={"password": password, "re_password": password},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert client.post("/api/v1/logout", headers=headers).status_code == 200
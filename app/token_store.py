@@ -0,0 +1,151 @@
+import hashlib
+import math
+import time
+from datetime import datetime
+from typing import List, Set
+
+import redis
+from jose import JWTError, jwt
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import models
+from .config import Settings
+
+
+def unverified_claims(token: str) -> dict:
+    try:
+        return jwt.get_unverified_claims(token)
+    except JWTError:
+        return {}
+
+
+def token_id(token: str) -> str:
+    # Tokens issued before the jti claim existed fall back to a digest.
+    jti = unverified_claims(token).get("jti")
+    return jti or hashlib.sha256(token.encode()).hexdigest()
+
+
+def token_expiry(token: str) -> float:
+    try:
+        return float(unverified_claims(token)["exp"])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def black_list_row(token: str, email: str) -> models.BlackLists:
+    return models.BlackLists(
+        jti=token_id(token),
+        email=email,
+        expires_at=datetime.utcfromtimestamp(token_expiry(token)),
+    )
+
+
+class DatabaseTokenStore:
+    # Each worker only sees its own writes immediately, so callers keep a
+    # local index in front of this store (see revocation.py).
+    shared = False
+
+    # Saving a token twice is not an error: with short-lived access tokens
+    # update_password can revoke a token that is then used to log out.
+    def save(self, db: Session, token: str, email: str):
+        black_list_token = black_list_row(token, email)
+        db.add(black_list_token)
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return self.find(db, token)
+        db.refresh(black_list_token)
+        return black_list_token
+
+    def find(self, db: Session, token: str):
+        return (
+            db.query(models.BlackLists)
+            .filter(models.BlackLists.jti == token_id(token))
+            .first()
+        )
+
+    async def save_async(self, db: AsyncSession, token: str, email: str):
+        black_list_token = black_list_row(token, email)
+        db.add(black_list_token)
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            return await self.find_async(db, token)
+        await db.refresh(black_list_token)
+        return black_list_token
+
+    async def find_async(self, db: AsyncSession, token: str):
+        result = await db.execute(
+            select(models.BlackLists).where(models.BlackLists.jti == token_id(token))
+        )
+        return result.scalars().first()
+
+    def find_many(self, db: Session, ids: List[str]) -> Set[str]:
+        rows = db.query(models.BlackLists.jti).filter(models.BlackLists.jti.in_(ids))
+        return {jti for jti, in rows}
+
+    async def find_many_async(self, db: AsyncSession, ids: List[str]) -> Set[str]:
+        result = await db.execute(
+            select(models.BlackLists.jti).where(models.BlackLists.jti.in_(ids))
+        )
+        return set(result.scalars())
+
+
+class RedisTokenStore:
+    # Visible to every worker and node at once; entries expire with the token.
+    shared = True
+
+    def __init__(self, client: redis.Redis, prefix: str = "revoked:"):
+        self.client = client
+        self.prefix = prefix
+
+    def key(self, token: str) -> str:
+        return self.prefix + token_id(token)
+
+    def save(self, db: Session, token: str, email: str):
+        ttl = math.ceil(token_expiry(token) - time.time())
+        if ttl > 0:
+            self.client.set(self.key(token), email, ex=ttl)
+        return True
+
+    def find(self, db: Session, token: str):
+        return bool(self.client.exists(self.key(token)))
+
+    async def save_async(self, db: AsyncSession, token: str, email: str):
+        return await run_in_threadpool(self.save, db, token, email)
+
+    async def find_async(self, db: AsyncSession, token: str):
+        return await run_in_threadpool(self.find, db, token)
+
+    def find_many(self, db: Session, ids: List[str]) -> Set[str]:
+        if not ids:
+            return set()
+        values = self.client.mget([self.prefix + key for key in ids])
+        return {key for key, value in zip(ids, values) if value is not None}
+
+    async def find_many_async(self, db: AsyncSession, ids: List[str]) -> Set[str]:
+        return await run_in_threadpool(self.find_many, db, ids)
+
+
+store = None
+
+
+def get_store():
+    global store
+    if store is None:
+        if Settings.TOKEN_STORE == "redis":
+            store = RedisTokenStore(redis.Redis.from_url(Settings.REDIS_URL))
+        else:
+            store = DatabaseTokenStore()
+    return store
+
+
+def set_store(new_store):
+    global store
+    store = new_store
@@ -0,0 +1,97 @@
+import logging
+from datetime import datetime
+from typing import List
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connectable
+
+from . import models
+from .database import engine
+from .token_store import token_expiry, token_id
+
+logger = logging.getLogger(__name__)
+
+
+def missing_columns(bind: Connectable) -> List[str]:
+    # create_all only creates missing tables, so columns added to an existing
+    # model never reach a database created by an older version.
+    inspector = inspect(bind)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in models.Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        present = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(
+            "{}.{}".format(table.name, column.name)
+            for column in table.columns
+            if column.name not in present
+        )
+    return missing
+
+
+def check(bind: Connectable):
+    missing = missing_columns(bind)
+    if missing:
+        raise RuntimeError(
+            "Database schema is out of date (missing {}); "
+            "run `python -m app.upgrade_schema` first".format(", ".join(missing))
+        )
+
+
+def backfill_black_lists(connection):
+    # Rows from before the jti column stored the whole token; derive the same
+    # id and expiry a logout would store today.
+    rows = connection.execute(
+        text("SELECT id, token FROM blacklists WHERE jti IS NULL")
+    ).fetchall()
+    for row_id, token in rows:
+        connection.execute(
+            text(
+                "UPDATE blacklists SET jti = :jti, expires_at = :expires_at "
+                "WHERE id = :id"
+            ),
+            {
+                "id": row_id,
+                "jti": token_id(token),
+                "expires_at": datetime.utcfromtimestamp(token_expiry(token)),
+            },
+        )
+    return len(rows)
+
+
+def upgrade(bind: Connectable):
+    models.Base.metadata.create_all(bind=bind)
+    with bind.begin() as connection:
+        inspector = inspect(connection)
+        for name in missing_columns(connection):
+            table_name, column_name = name.split(".")
+            column = models.Base.metadata.tables[table_name].columns[column_name]
+            connection.execute(
+                text(
+                    "ALTER TABLE {} ADD COLUMN {} {}".format(
+                        table_name,
+                        column_name,
+                        column.type.compile(dialect=connection.dialect),
+                    )
+                )
+            )
+            logger.info("Added column %s", name)
+
+        legacy = {column["name"] for column in inspector.get_columns("blacklists")}
+        if "token" in legacy:
+            logger.info(
+                "Backfilled %d blacklist rows", backfill_black_lists(connection)
+            )
+            # SQLite cannot drop a UNIQUE column; new rows leave it NULL.
+            if connection.dialect.name != "sqlite":
+                connection.execute(text("ALTER TABLE blacklists DROP COLUMN token"))
+
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    upgrade(engine)
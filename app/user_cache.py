@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from . import metrics, models
+from .config import Settings
+
+user_cache_hits = metrics.counter(
+    "user_cache_hits_total", "User lookups served from cache."
+)
+user_cache_misses = metrics.counter(
+    "user_cache_misses_total", "User lookups that went to the database."
+)
+
+
+@dataclass(frozen=True)
+class CachedUser:
+    id: int
+    email: str
+    # Needed by update_password; never serialised (/api/v1/me uses UserOut).
+    hashed_password: str = field(repr=False)
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    user_profile_image: Optional[str] = None
+
+    @classmethod
+    def from_orm(cls, user: models.User) -> "CachedUser":
+        return cls(
+            id=user.id,
+            email=user.email,
+            hashed_password=user.hashed_password,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            user_profile_image=user.user_profile_image,
+        )
+
+
+class UserCache:
+    def __init__(
+        self,
+        ttl: float = Settings.USER_CACHE_TTL_SECONDS,
+        max_size: int = Settings.USER_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        # email -> (expires_at, CachedUser), oldest first
+        self.entries = OrderedDict()
+        self.emails_by_id = {}
+        self._lock = threading.Lock()
+
+    def get(self, email: str) -> Optional[CachedUser]:
+        with self._lock:
+            entry = self.entries.get(email)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(email)
+                user_cache_hits.inc()
+                return entry[1]
+            if entry is not None:
+                self._drop(email)
+        user_cache_misses.inc()
+        return None
+
+    def get_by_id(self, user_id: int) -> Optional[CachedUser]:
+        email = self.emails_by_id.get(user_id)
+        return self.get(email) if email is not None else None
+
+    def put(self, user: models.User) -> CachedUser:
+        snapshot = CachedUser.from_orm(user)
+        if self.ttl <= 0 or self.max_size <= 0:
+            return snapshot
+        with self._lock:
+            self.entries[snapshot.email] = (time.monotonic() + self.ttl, snapshot)
+            self.entries.move_to_end(snapshot.email)
+            self.emails_by_id[snapshot.id] = snapshot.email
+            while len(self.entries) > self.max_size:
+                self._drop(next(iter(self.entries)))
+        return snapshot
+
+    def invalidate(self, email: str = None, user_id: int = None):
+        with self._lock:
+            if email is None and user_id is not None:
+                email = self.emails_by_id.get(user_id)
+            if email is not None:
+                self._drop(email)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.emails_by_id.clear()
+
+    def _drop(self, email: str):
+        entry = self.entries.pop(email, None)
+        if entry is not None:
+            self.emails_by_id.pop(entry[1].id, None)
+
+
+cache = UserCache()
@@ -0,0 +1,84 @@
+"""Latency under a login flood, with and without the admission limits.
+
+    python -m benchmarks.bench_admission --clients 64 --duration 5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from app import admission, hashing
+from app.config import Settings
+
+from .common import new_credentials, register_and_login, summarize, use_local_database
+
+
+async def run_mode(app, bounded: bool, clients: int, duration: float):
+    admission.bulkheads = admission.configure() if bounded else {}
+    email, password = new_credentials()
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        token = await register_and_login(client, email, password)
+        headers = {"Authorization": "Bearer " + token}
+        deadline = time.perf_counter() + duration
+        served, shed = [], []
+
+        async def login_loop():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.post(
+                    "/api/v1/login", data={"username": email, "password": password}
+                )
+                elapsed = time.perf_counter() - start
+                if response.status_code == 503:
+                    shed.append(elapsed)
+                    await asyncio.sleep(0.05)
+                else:
+                    served.append(elapsed)
+
+        async def me_loop():
+            samples = []
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await client.get("/api/v1/me", headers=headers)
+                samples.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+            return samples
+
+        results = await asyncio.gather(
+            me_loop(), *(login_loop() for _ in range(clients))
+        )
+    hashing.shutdown_executor()
+    return {
+        "login_served": summarize(served),
+        "login_shed": summarize(shed),
+        "me": summarize(results[0]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    # Every client logs in from the same address; keep the throttle out of it.
+    Settings.LOGIN_IP_LIMIT = 10 ** 9
+    Settings.LOGIN_FAILURE_LIMIT = 10 ** 9
+
+    app = use_local_database()
+    report = {
+        "limits": {
+            "hashing": Settings.ADMISSION_HASHING_LIMIT,
+            "queue": Settings.ADMISSION_HASHING_QUEUE,
+            "queue_timeout": Settings.ADMISSION_QUEUE_TIMEOUT,
+        }
+    }
+    for label, bounded in (("unbounded", False), ("bounded", True)):
+        report[label] = asyncio.run(run_mode(app, bounded, args.clients, args.duration))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Token verification cost per request: decoding every time vs the claims cache.
+
+    python -m benchmarks.bench_claims_cache --requests 20000 --tokens 100
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from app import signing
+from app.claims_cache import ClaimsCache
+
+
+def tokens(count: int):
+    expires = datetime.utcnow() + timedelta(minutes=5)
+    return [
+        signing.keyring.encode(
+            {
+                "sub": "user{}@example.com".format(number),
+                "exp": expires,
+                "jti": uuid.uuid4().hex,
+            }
+        )
+        for number in range(count)
+    ]
+
+
+def measure(decode, batch, requests: int) -> dict:
+    start = time.perf_counter()
+    for number in range(requests):
+        decode(batch[number % len(batch)])
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "seconds": elapsed,
+        "microseconds_per_request": elapsed / requests * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--tokens", type=int, default=100)
+    args = parser.parse_args()
+
+    batch = tokens(args.tokens)
+    cache = ClaimsCache(max_size=args.tokens)
+    report = {
+        "algorithm": signing.keyring.algorithm,
+        "decode_every_request": measure(signing.keyring.decode, batch, args.requests),
+        "claims_cache": measure(cache.decode, batch, args.requests),
+    }
+    report["claims_cache"]["hit_rate"] = cache.stats()["hit_rate"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Throughput of /api/v1/me and /api/v1/login with sync Session vs AsyncSession.
+
+    python -m benchmarks.bench_db_modes --concurrency 32 --duration 5 \\
+        --sync-url postgresql://... --async-url postgresql+asyncpg://...
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from app import user_cache
+
+from .common import (
+    BENCH_ASYNC_DATABASE_URL,
+    BENCH_DATABASE_URL,
+    new_credentials,
+    register_and_login,
+    summarize,
+    use_local_async_database,
+    use_local_database,
+)
+
+
+async def measure(app, endpoint: str, concurrency: int, duration: float):
+    email, password = new_credentials()
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        token = await register_and_login(client, email, password)
+        headers = {"Authorization": "Bearer " + token}
+        deadline = time.perf_counter() + duration
+
+        async def request():
+            if endpoint == "me":
+                # Measure the database path, not the user cache.
+                user_cache.cache.clear()
+                await client.get("/api/v1/me", headers=headers)
+            else:
+                await client.post(
+                    "/api/v1/login", data={"username": email, "password": password}
+                )
+
+        async def worker():
+            samples = []
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await request()
+                samples.append(time.perf_counter() - start)
+            return samples
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    samples = [sample for result in results for sample in result]
+    return dict(summarize(samples), requests_per_second=len(samples) / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--sync-url", default=BENCH_DATABASE_URL)
+    parser.add_argument("--async-url", default=BENCH_ASYNC_DATABASE_URL)
+    args = parser.parse_args()
+
+    report = {}
+    for mode in ("sync", "async"):
+        if mode == "sync":
+            app = use_local_database(args.sync_url)
+        else:
+            app = use_local_async_database(args.async_url, args.sync_url)
+        report[mode] = {
+            endpoint: asyncio.run(
+                measure(app, endpoint, args.concurrency, args.duration)
+            )
+            for endpoint in ("me", "login")
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""End-to-end load test of the auth flows, run in-process against a local database.
+
+Each virtual user repeats register -> login -> me -> update_password -> logout
+(and forgot_password with --forgot-password, delivered through the outbox to
+a local SMTP stand-in). Prints throughput and p50/p95/p99 per endpoint as
+JSON; --output also writes it to a file for comparing commits.
+
+    python -m benchmarks.bench_flows --users 16 --iterations 5 --forgot-password
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import time
+from collections import defaultdict
+
+import httpx
+from aiosmtpd.controller import Controller
+
+from app import admission, hashing, outbox_worker
+from app.config import Settings
+from app.mail_delivery import SMTPConnectionPool
+
+from .common import (
+    BENCH_DATABASE_URL,
+    CountingHandler,
+    free_port,
+    local_sessionmaker,
+    new_credentials,
+    summarize,
+    use_local_database,
+)
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def call(self, name: str, request):
+        start = time.perf_counter()
+        response = await request
+        self.samples[name].append(time.perf_counter() - start)
+        self.statuses[name][str(response.status_code)] += 1
+        return response
+
+
+async def user_flow(client, recorder: Recorder, iterations: int, forgot: bool):
+    for _ in range(iterations):
+        email, password = new_credentials()
+        # A failed step (a 503 from admission control, say) ends the flow.
+        response = await recorder.call(
+            "register",
+            client.post(
+                "/api/v1/register", json={"email": email, "password": password}
+            ),
+        )
+        if response.status_code != 200:
+            continue
+        response = await recorder.call(
+            "login",
+            client.post(
+                "/api/v1/login", data={"username": email, "password": password}
+            ),
+        )
+        if response.status_code != 200:
+            continue
+        headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+        await recorder.call("me", client.get("/api/v1/me", headers=headers))
+        new_password = new_credentials()[1]
+        await recorder.call(
+            "update_password",
+            client.put(
+                "/api/v1/update_password",
+                json={"password": new_password, "re_password": new_password},
+                headers=headers,
+            ),
+        )
+        await recorder.call("logout", client.post("/api/v1/logout", headers=headers))
+        if forgot:
+            await recorder.call(
+                "forgot_password",
+                client.post("/api/v1/forgot_password", json={"email": email}),
+            )
+
+
+async def drain_outbox(session_factory, pool: SMTPConnectionPool, stop: asyncio.Event):
+    # Stands in for the mail-worker service until the flows finish and the
+    # outbox is empty.
+    while True:
+        db = session_factory()
+        try:
+            claimed = await outbox_worker.process_batch(db, pool)
+        finally:
+            db.close()
+        if not claimed:
+            if stop.is_set():
+                return
+            await asyncio.sleep(0.05)
+
+
+async def run(app, args, smtp_port: int):
+    recorder = Recorder()
+    stop = asyncio.Event()
+    pool = SMTPConnectionPool(hostname="127.0.0.1", port=smtp_port)
+    drainer = asyncio.create_task(
+        drain_outbox(local_sessionmaker(args.database_url), pool, stop)
+    )
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                user_flow(client, recorder, args.iterations, args.forgot_password)
+                for _ in range(args.users)
+            )
+        )
+        elapsed = time.perf_counter() - start
+    stop.set()
+    await drainer
+    await pool.close()
+    hashing.shutdown_executor()
+    return recorder, elapsed
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--forgot-password", action="store_true")
+    parser.add_argument("--database-url", default=BENCH_DATABASE_URL)
+    parser.add_argument("--hash-workers", type=int, default=Settings.HASH_POOL_WORKERS)
+    parser.add_argument(
+        "--no-admission",
+        action="store_true",
+        help="disable the per-route concurrency limits instead of shedding with 503",
+    )
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    # Every virtual user shares one client address, which the login throttle
+    # would otherwise treat as a single abusive client.
+    Settings.LOGIN_IP_LIMIT = 10 ** 9
+    Settings.HASH_POOL_WORKERS = args.hash_workers
+    if args.no_admission:
+        admission.bulkheads = {}
+
+    app = use_local_database(args.database_url)
+    handler, port = CountingHandler(), free_port()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        recorder, elapsed = asyncio.run(run(app, args, port))
+    finally:
+        controller.stop()
+
+    total = sum(len(samples) for samples in recorder.samples.values())
+    report = {
+        "revision": git_revision(),
+        "config": {
+            "users": args.users,
+            "iterations": args.iterations,
+            "forgot_password": args.forgot_password,
+            "database": args.database_url.split("://")[0],
+            "hash_workers": args.hash_workers,
+            "admission": not args.no_admission,
+            "token_mode": Settings.TOKEN_MODE,
+            "jwt_algorithm": Settings.JWT_ALGORITHM,
+        },
+        "seconds": elapsed,
+        "requests_per_second": total / elapsed,
+        "flows_per_second": args.users * args.iterations / elapsed,
+        "emails_delivered": handler.received,
+        "endpoints": {
+            name: dict(
+                summarize(samples),
+                requests_per_second=len(samples) / elapsed,
+                statuses=dict(recorder.statuses[name]),
+            )
+            for name, samples in recorder.samples.items()
+        },
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""/api/v1/me latency while logins run concurrently, with and without the hashing pool.
+
+    python -m benchmarks.bench_hashing --logins 8 --duration 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from app import hashing
+from app.config import Settings
+
+from .common import new_credentials, register_and_login, summarize, use_local_database
+
+
+async def run_mode(app, workers: int, logins: int, duration: float):
+    Settings.HASH_POOL_WORKERS = workers
+    hashing.shutdown_executor()
+    email, password = new_credentials()
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        token = await register_and_login(client, email, password)
+        headers = {"Authorization": "Bearer " + token}
+        deadline = time.perf_counter() + duration
+
+        async def login_loop():
+            while time.perf_counter() < deadline:
+                await client.post(
+                    "/api/v1/login", data={"username": email, "password": password}
+                )
+
+        async def me_loop():
+            samples = []
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await client.get("/api/v1/me", headers=headers)
+                samples.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+            return samples
+
+        results = await asyncio.gather(
+            me_loop(), *(login_loop() for _ in range(logins))
+        )
+    hashing.shutdown_executor()
+    return summarize(results[0])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    app = use_local_database()
+    report = {}
+    for label, workers in (("inline", 0), ("process_pool", args.workers)):
+        report[label] = asyncio.run(run_mode(app, workers, args.logins, args.duration))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Encode/decode throughput of each JWT codec, as a pytest-benchmark suite.
+
+    pytest benchmarks/bench_jwt_codecs.py --benchmark-columns=ops,mean
+"""
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import signing
+
+CASES = [
+    ("jose", "HS256"),
+    ("pyjwt", "HS256"),
+    ("builtin", "HS256"),
+    ("jose", "RS256"),
+    ("pyjwt", "RS256"),
+]
+
+
+@pytest.fixture(scope="module")
+def keys_dir():
+    with tempfile.TemporaryDirectory() as directory:
+        signing.rotate(directory, "RS256", retire_after=3600)
+        yield directory
+
+
+@pytest.fixture(params=CASES, ids=["-".join(case) for case in CASES])
+def keyring(request, keys_dir):
+    codec, algorithm = request.param
+    keyring = signing.KeyRing(algorithm, keys_dir, "", codec)
+    keyring.load()
+    return keyring
+
+
+def claims():
+    return {
+        "sub": "bench@example.com",
+        "exp": datetime.utcnow() + timedelta(minutes=5),
+        "jti": uuid.uuid4().hex,
+    }
+
+
+def test_encode(benchmark, keyring):
+    payload = claims()
+    benchmark.group = "encode"
+    benchmark(keyring.encode, payload)
+
+
+def test_decode(benchmark, keyring):
+    token = keyring.encode(claims())
+    benchmark.group = "decode"
+    assert benchmark(keyring.decode, token)["sub"] == "bench@example.com"
@@ -0,0 +1,101 @@
+"""Messages per second: a FastMail session per message vs pooled SMTP connections.
+
+Runs against a local aiosmtpd server, so no real mail is sent.
+
+    python -m benchmarks.bench_mail --messages 500
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from aiosmtpd.controller import Controller
+from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
+
+from app.email_templates import renderer
+from app.mail_delivery import SMTPConnectionPool
+from app.send_email import build_message, conf
+
+from .common import CountingHandler, free_port
+
+BODY = {"protocol": "http", "domain": "localhost", "url": "/reset_password"}
+TEMPLATE = "password_reset_email.html"
+
+
+async def per_message_sessions(port: int, count: int, concurrency: int):
+    local_conf = ConnectionConfig(
+        **dict(
+            conf.dict(),
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=port,
+            MAIL_TLS=False,
+            MAIL_SSL=False,
+            USE_CREDENTIALS=False,
+        )
+    )
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send(number: int):
+        async with slots:
+            message = MessageSchema(
+                subject="Password Reset",
+                recipients=["user{}@example.com".format(number)],
+                body=renderer.render(TEMPLATE, BODY),
+                subtype="html",
+            )
+            await FastMail(local_conf).send_message(message)
+
+    await asyncio.gather(*(send(number) for number in range(count)))
+
+
+async def pooled_connections(port: int, count: int, concurrency: int):
+    # What the outbox worker does: each send borrows a connection that stays
+    # open for the next one.
+    pool = SMTPConnectionPool(hostname="127.0.0.1", port=port, size=concurrency)
+
+    async def send(number: int):
+        message = build_message(
+            "Password Reset", "user{}@example.com".format(number), BODY, TEMPLATE
+        )
+        smtp = await pool.acquire()
+        try:
+            await smtp.send_message(message)
+        finally:
+            await pool.release(smtp)
+
+    try:
+        await asyncio.gather(*(send(number) for number in range(count)))
+    finally:
+        await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    report = {}
+    for label, run in (
+        ("fastmail_per_message", per_message_sessions),
+        ("pooled_connections", pooled_connections),
+    ):
+        handler, port = CountingHandler(), free_port()
+        controller = Controller(handler, hostname="127.0.0.1", port=port)
+        controller.start()
+        try:
+            start = time.perf_counter()
+            asyncio.run(run(port, args.messages, args.concurrency))
+            elapsed = time.perf_counter() - start
+        finally:
+            controller.stop()
+        report[label] = {
+            "messages": handler.received,
+            "seconds": elapsed,
+            "messages_per_second": handler.received / elapsed,
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Serving a profile image: read into memory vs chunked streaming vs zero-copy.
+
+Drives the ASGI responses directly. The chunked run is what uvicorn, which has
+no zero-copy support, actually serves. The zero-copy run plays the server side
+of the extension with os.sendfile() into /dev/null.
+
+    python -m benchmarks.bench_profile_images --size-mb 5 --requests 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from starlette.responses import Response
+
+from app.profile_images import FileRangeResponse
+
+from .common import summarize
+
+
+async def run(make_response, scope, requests: int):
+    sink = os.open(os.devnull, os.O_WRONLY)
+    sent = 0
+
+    async def send(message):
+        nonlocal sent
+        if message["type"] == "http.response.zerocopy":
+            offset, count = message["offset"], message["count"]
+            while count:
+                written = os.sendfile(sink, message["file"].fileno(), offset, count)
+                offset, count, sent = offset + written, count - written, sent + written
+        elif message["type"] == "http.response.body":
+            sent += len(message["body"])
+
+    samples = []
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            await make_response()(scope, None, send)
+            samples.append(time.perf_counter() - start)
+    finally:
+        os.close(sink)
+    return samples, sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=5)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    with tempfile.NamedTemporaryFile(delete=False) as image:
+        image.write(os.urandom(size))
+
+    def in_memory():
+        with open(image.name, "rb") as file:
+            return Response(file.read(), media_type="image/png")
+
+    def streamed():
+        return FileRangeResponse(image.name, 0, size - 1, 200, {}, "image/png")
+
+    report = {}
+    try:
+        for label, make_response, scope in (
+            ("read_into_memory", in_memory, {}),
+            ("chunked_stream", streamed, {}),
+            (
+                "zerocopy_sendfile",
+                streamed,
+                {"extensions": {"http.response.zerocopy": {}}},
+            ),
+        ):
+            tracemalloc.start()
+            samples, sent = asyncio.run(run(make_response, scope, args.requests))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report[label] = dict(
+                summarize(samples),
+                bytes_sent=sent,
+                peak_python_memory_mb=peak / 1024 / 1024,
+            )
+    finally:
+        os.remove(image.name)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
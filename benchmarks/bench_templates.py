@@ -0,0 +1,68 @@
+"""Render cost per email: a per-call Jinja environment vs the precompiled renderer.
+
+    python -m benchmarks.bench_templates --messages 5000
+"""
+import argparse
+import json
+import time
+
+from jinja2 import Environment, FileSystemLoader
+
+from app.email_templates import TEMPLATE_FOLDER, renderer
+
+TEMPLATE = "password_reset_email.html"
+
+
+def bodies(count: int):
+    return [
+        {
+            "protocol": "http",
+            "domain": "localhost",
+            "url": "/reset_password?reset_password_token={}".format(number),
+        }
+        for number in range(count)
+    ]
+
+
+def per_call_environment(batch):
+    # What build_message did before via ConnectionConfig.template_engine():
+    # a fresh Environment, so every message loads and compiles the template.
+    for body in batch:
+        environment = Environment(loader=FileSystemLoader(str(TEMPLATE_FOLDER)))
+        environment.get_template(TEMPLATE).render(body=body)
+
+
+def precompiled(batch):
+    for body in batch:
+        renderer.render(TEMPLATE, body)
+
+
+def precompiled_batch(batch):
+    renderer.render_batch(TEMPLATE, batch)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+
+    batch = bodies(args.messages)
+    report = {}
+    for label, run in (
+        ("per_call_environment", per_call_environment),
+        ("precompiled", precompiled),
+        ("precompiled_batch", precompiled_batch),
+    ):
+        start = time.perf_counter()
+        run(batch)
+        elapsed = time.perf_counter() - start
+        report[label] = {
+            "messages": args.messages,
+            "seconds": elapsed,
+            "microseconds_per_message": elapsed / args.messages * 1e6,
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
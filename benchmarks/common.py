@@ -0,0 +1,105 @@
+import socket
+import statistics
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import main
+from app.database import Base
+
+BENCH_DATABASE_URL = "sqlite:///./bench.db"
+BENCH_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./bench.db"
+
+
+def _connect_args(url: str):
+    return {"check_same_thread": False} if url.startswith("sqlite") else {}
+
+
+def local_sessionmaker(url: str = BENCH_DATABASE_URL):
+    engine = create_engine(url, connect_args=_connect_args(url))
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def use_local_database(url: str = BENCH_DATABASE_URL):
+    BenchSessionLocal = local_sessionmaker(url)
+    engine = BenchSessionLocal.kw["bind"]
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    def override_get_db():
+        db = BenchSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    main.app.dependency_overrides[main.get_db] = override_get_db
+    return main.app
+
+
+def use_local_async_database(
+    url: str = BENCH_ASYNC_DATABASE_URL, sync_url: str = BENCH_DATABASE_URL
+):
+    use_local_database(sync_url)
+    async_engine = create_async_engine(url)
+    BenchAsyncSessionLocal = sessionmaker(
+        bind=async_engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_get_db():
+        async with BenchAsyncSessionLocal() as db:
+            yield db
+
+    main.app.dependency_overrides[main.get_db] = override_get_db
+    return main.app
+
+
+def new_credentials():
+    return str(uuid.uuid4()) + "@example.com", str(uuid.uuid4())
+
+
+async def register_and_login(client, email: str, password: str) -> str:
+    await client.post(
+        "/api/v1/register",
+        json={"email": email, "password": password, "first_name": "bench"},
+    )
+    response = await client.post(
+        "/api/v1/login", data={"username": email, "password": password}
+    )
+    return response.json()["access_token"]
+
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.mean(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+    }
+
+
+class CountingHandler:
+    # aiosmtpd handler standing in for the SMTP server; it only counts.
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]